@@ -1,16 +1,18 @@
 from src.agents.tools import Tool
 from src.docstore.wikipedia import DocstoreExplorer, ReActWikipedia
+from src.tools.base import ObservationPolicy
 
 
 def generate_tools(args):
     web_searcher = ReActWikipedia()
+    docstore = DocstoreExplorer(web_searcher)
     if args.model_type == "vllm":
         # If we use LLaMA with vLLM for the movie recommendation task,
         # we frequently get the context length error, so we limit the
-        # wikipedia context length to 400 and only return the first sentence.
-        docstore = DocstoreExplorer(web_searcher, char_limit=400, one_sentence=True)
+        # wikipedia context length to 400 and only return one sentence.
+        observation_policy = ObservationPolicy(max_sentences=1, max_chars=400)
     else:
-        docstore = DocstoreExplorer(web_searcher)
+        observation_policy = None
 
     tools = [
         Tool(
@@ -22,6 +24,7 @@ def generate_tools(args):
                 " - Returns the first paragraph if the entity is found.\n"
             ),
             stringify_rule=lambda args: f"search({args[0]})",
+            observation_policy=observation_policy,
         ),
     ]
     return tools
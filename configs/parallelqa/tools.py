@@ -60,7 +60,9 @@ def run_llm_math_chain_factory(llm_math_chain):
                 f"{context_str}\n\n"
                 f"Question: {question}\n\n"
             )
-        response = llm_math_chain.run(prompt)
+        # use the async chain, otherwise the LLM call blocks the event loop
+        # and serializes all the parallel math tasks
+        response = await llm_math_chain.arun(prompt)
         response = response.split("Answer:")[1].strip()
         try:
             response = float(response)
@@ -81,7 +83,7 @@ docstore = DocstoreExplorer(web_searcher)
 def generate_tools(args, model_name):
     llm_math_chain = get_model(
         model_type=args.model_type,
-        api_key=args.api_key,
+        model_name=model_name,
         vllm_port=args.vllm_port,
         stream=False,
         temperature=0,
@@ -2,7 +2,6 @@ import argparse
 import asyncio
 import json
 import os
-import time
 import shutil
 
 import numpy as np
@@ -22,9 +21,16 @@ from configs.parallelqa_react.tools import (
     generate_tools as parallelqa_react_generate_tools,
 )
 from src.callbacks.callbacks import StatsCallbackHandler
+from src.docstore.cache import SearchCache
+from src.docstore.wikipedia import DocstoreExplorer, ReActWikipedia
 from src.llm_compiler.constants import END_OF_PLAN
+from src.llm_compiler.context_budget import ContextBudget
 from src.llm_compiler.llm_compiler import LLMCompiler
+from src.llm_compiler.observation_compressor import ObservationCompressor
+from src.llm_compiler.plan_cache import PlanCache, PlanTemplateCache
+from src.llm_compiler.tool_cache import ToolResultCache
 from src.react.base import initialize_react_agent_executor
+from src.tools.base import RetryPolicy
 from src.utils.evaluation_utils import arun_and_time, compare_answer, normalize_answer
 from src.utils.logger_utils import enable_logging, flush_results
 from src.utils.model_utils import get_model
@@ -34,6 +40,21 @@ argparser.add_argument("--N", type=int, default=None, help="number of samples")
 argparser.add_argument("--react", action="store_true", help="Run ReAct")
 argparser.add_argument("--stream", action="store_true", help="stream plan")
 argparser.add_argument("--logging", action="store_true", help="logging")
+argparser.add_argument(
+    "--stream_join",
+    action="store_true",
+    help="stream the joinner output and return as soon as its action is generated",
+)
+argparser.add_argument(
+    "--join_prefill",
+    action="store_true",
+    help="prefill the joinner prompt while the tasks run, needs prefix caching",
+)
+argparser.add_argument(
+    "--typed_observations",
+    action="store_true",
+    help="pass raw observations to arguments that are exactly a reference, e.g. $1",
+)
 argparser.add_argument(
     "--model_type",
     type=str,
@@ -55,10 +76,119 @@ argparser.add_argument("--store", type=str, required=True, help="store path")
 argparser.add_argument("--api_key", type=str, default=None, help="openai api key")
 argparser.add_argument("--do_benchmark", action="store_true", help="do benchmark")
 argparser.add_argument(
-    "--sleep_per_iter",
+    "--tool_max_concurrency",
     type=int,
     default=None,
-    help="Sleep seconds per iter to avoid rate limit",
+    help="Max number of concurrent calls per tool, across all queries",
+)
+argparser.add_argument(
+    "--tool_rate_limit",
+    type=float,
+    default=None,
+    help="Max number of calls per second per tool, to avoid rate limit",
+)
+argparser.add_argument(
+    "--concurrency",
+    type=int,
+    default=1,
+    help="Number of queries to run concurrently",
+)
+argparser.add_argument(
+    "--tool_max_retries",
+    type=int,
+    default=0,
+    help="Max number of retries of a failed tool call, with exponential backoff",
+)
+argparser.add_argument(
+    "--hedge",
+    action="store_true",
+    help="Issue a duplicate tool call when a call is slower than the tool's p95",
+)
+argparser.add_argument(
+    "--task_timeout",
+    type=float,
+    default=None,
+    help="Max seconds a tool call can take before its task fails",
+)
+argparser.add_argument(
+    "--plan_timeout",
+    type=float,
+    default=None,
+    help="Max seconds to run the tasks of a plan",
+)
+argparser.add_argument(
+    "--tool_cache",
+    action="store_true",
+    help="memoize tool results across plans and queries in memory",
+)
+argparser.add_argument(
+    "--tool_cache_ttl",
+    type=float,
+    default=None,
+    help="Seconds until a memoized tool result expires",
+)
+argparser.add_argument(
+    "--plan_cache",
+    action="store_true",
+    help="reuse the plan of a repeated question instead of calling the planner",
+)
+argparser.add_argument(
+    "--plan_cache_path",
+    type=str,
+    default=None,
+    help="Path to a SQLite file to also keep the cached plans across runs",
+)
+argparser.add_argument(
+    "--plan_cache_ttl",
+    type=float,
+    default=None,
+    help="Seconds until a cached plan expires",
+)
+argparser.add_argument(
+    "--plan_template_cache",
+    action="store_true",
+    help="reuse plans for questions that only differ in their entities",
+)
+argparser.add_argument(
+    "--context_max_tokens",
+    type=int,
+    default=None,
+    help="Max tokens of the previous plans and results fed back to the LLMs",
+)
+argparser.add_argument(
+    "--observation_max_tokens",
+    type=int,
+    default=None,
+    help="Max tokens of each observation fed back to the LLMs",
+)
+argparser.add_argument(
+    "--compress_observations",
+    action="store_true",
+    help="only feed back the sentences of the observations relevant to the question",
+)
+argparser.add_argument(
+    "--observation_max_sentences",
+    type=int,
+    default=3,
+    help="Max sentences of each observation kept by --compress_observations",
+)
+
+argparser.add_argument(
+    "--search_cache",
+    type=str,
+    default=None,
+    help="Path to a SQLite file to cache search observations across runs",
+)
+argparser.add_argument(
+    "--search_cache_ttl",
+    type=float,
+    default=None,
+    help="Seconds until a cached search observation expires",
+)
+argparser.add_argument(
+    "--search_cache_read_only",
+    action="store_true",
+    help="Replay search observations from an existing cache without writing to it",
 )
 
 # vllm-specific arguments
@@ -105,6 +235,35 @@ def get_tools(model_name, args):
     return tools
 
 
+def set_search_cache(tools, args):
+    """Attach a persistent search cache to the docstores behind the tools."""
+    if not args.search_cache:
+        return None
+    search_cache = SearchCache(
+        args.search_cache,
+        ttl=args.search_cache_ttl,
+        read_only=args.search_cache_read_only,
+    )
+    for tool in tools:
+        docstore = getattr(tool.func, "__self__", None)
+        if isinstance(docstore, DocstoreExplorer):
+            docstore.cache = search_cache
+    return search_cache
+
+
+def set_tool_policies(tools, args):
+    """Apply the concurrency and rate limits and the retry policy to the tools,
+    unless the tool config already declares its own."""
+    for tool in tools:
+        if tool.max_concurrency is None:
+            tool.max_concurrency = args.tool_max_concurrency
+        if tool.rate_limit is None:
+            tool.rate_limit = args.tool_rate_limit
+        if tool.retry_policy is None and args.tool_max_retries > 0:
+            tool.retry_policy = RetryPolicy(max_retries=args.tool_max_retries)
+        tool.hedge = tool.hedge or args.hedge
+
+
 def get_configs(args):
     if args.benchmark_name == "movie":
         if args.react:
@@ -131,19 +290,18 @@ async def main():
     model_name = args.model_name or configs["default_model"]
     dataset = get_dataset(args)
     tools = get_tools(model_name, args)
+    search_cache = set_search_cache(tools, args)
+    set_tool_policies(tools, args)
     if args.model_type in ["openai", "azure"]:
         prompt_type = "gpt"
     else:
         assert args.model_type in ["vllm", "friendli"]
         prompt_type = "llama"
 
-    logging_callback = None
     if args.react:
         assert "prompt" in configs, "React config requires a prompt"
         prompt = configs["prompt"][prompt_type]
         print("Run React")
-        if args.do_benchmark:
-            logging_callback = StatsCallbackHandler()
 
         llm = get_model(
             model_type=args.model_type,
@@ -166,7 +324,7 @@ async def main():
             model_type=args.model_type,
             model_name=model_name,
             vllm_port=args.vllm_port,
-            stream=False,
+            stream=args.stream_join,
             temperature=0,
         )
         planner_llm = get_model(
@@ -190,52 +348,101 @@ async def main():
             joinner_prompt_final=prompts.get("output_prompt_final"),
             max_replans=configs["max_replans"],
             benchmark=args.do_benchmark,
+            joinner_stream=args.stream_join,
+            join_prefill=args.join_prefill,
+            typed_observations=args.typed_observations,
+            task_timeout=args.task_timeout,
+            plan_timeout=args.plan_timeout,
+            tool_cache=(
+                ToolResultCache(ttl=args.tool_cache_ttl) if args.tool_cache else None
+            ),
+            plan_cache=(
+                PlanCache(path=args.plan_cache_path, ttl=args.plan_cache_ttl)
+                if args.plan_cache
+                else None
+            ),
+            plan_template_cache=(
+                PlanTemplateCache() if args.plan_template_cache else None
+            ),
+            context_budget=(
+                ContextBudget(
+                    max_tokens=args.context_max_tokens,
+                    max_observation_tokens=args.observation_max_tokens,
+                )
+                if args.context_max_tokens or args.observation_max_tokens
+                else None
+            ),
+            observation_compressor=(
+                ObservationCompressor(max_sentences=args.observation_max_sentences)
+                if args.compress_observations
+                else None
+            ),
         )
 
     all_results = {}
     if os.path.exists(args.store):
         all_results = json.load(open(args.store, "r"))
 
-    for i, example in enumerate(dataset):
-        if i == args.N:
-            break
-        id = example["id"]
+    examples = dataset[: args.N]
+    example_ids = [str(example["id"]) for example in examples]
+    # bound the number of queries in flight
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_example(example):
+        id = str(example["id"])
         question = example["question"]
         _label = example["answer"]
         label = normalize_answer(_label)
 
-        if str(id) not in all_results:
+        async with semaphore:
+            # each query gets its own stats handler so that concurrent
+            # queries do not mix their stats
+            logging_callback = (
+                StatsCallbackHandler() if args.do_benchmark and args.react else None
+            )
             raw_answer, e2e_time = await arun_and_time(
                 agent.arun,
                 question,
                 callbacks=[logging_callback] if logging_callback is not None else None,
             )
-            normalized_answer = normalize_answer(raw_answer)
-            print(f"Answer: {raw_answer}")
-            print(normalized_answer, "<>", label)
-            print("time: ", e2e_time)
-            all_results[id] = {
-                "question": question,
-                "label": _label,  # not normalized
-                "answer": raw_answer,  # not normalized
-                "time": e2e_time,
-            }
             stats = None
             if args.do_benchmark and args.react:
-                assert logging_callback is not None
                 stats = {"total": logging_callback.get_stats()}
-                logging_callback.reset()
             elif args.do_benchmark and not args.react:
                 stats = agent.get_all_stats()
                 agent.reset_all_stats()
+            if stats is not None and search_cache is not None:
+                # across all the queries
+                stats["search_cache"] = search_cache.get_stats()
 
-            all_results[id]["stats"] = stats
-
-        flush_results(args.store, all_results)
+        normalized_answer = normalize_answer(raw_answer)
+        print(f"Answer: {raw_answer}")
+        print(normalized_answer, "<>", label)
+        print("time: ", e2e_time)
+        all_results[id] = {
+            "question": question,
+            "label": _label,  # not normalized
+            "answer": raw_answer,  # not normalized
+            "time": e2e_time,
+            "stats": stats,
+        }
+        # persist in the dataset order, regardless of the completion order
+        ordered_results = {k: all_results[k] for k in example_ids if k in all_results}
+        ordered_results.update(all_results)
+        flush_results(args.store, ordered_results)
         # shutil.copyfile(args.store, args.store + ".bak")  # uncomment to backup
 
-        if args.sleep_per_iter:
-            time.sleep(args.sleep_per_iter)
+    await asyncio.gather(
+        *[
+            run_example(example)
+            for example in examples
+            if str(example["id"]) not in all_results
+        ]
+    )
+    await ReActWikipedia.aclose_all()
+    if search_cache is not None:
+        print(f"Search cache: {search_cache.get_stats()}")
+        search_cache.close()
 
     accuracy = np.average(
         [
@@ -1,4 +1,6 @@
 import time
+from typing import Any
+from uuid import UUID
 
 import tiktoken
 from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
@@ -14,17 +16,22 @@ class StatsCallbackHandler(BaseCallbackHandler):
         self.input_tokens = 0
         self.output_tokens = 0
         self.all_times = []
-        self.start_time = 0
+        # start time of each in-flight LLM call, keyed by its run_id
+        self.start_times: dict[UUID, float] = {}
 
-    def on_chat_model_start(self, serialized, prompts, **kwargs):
-        self.start_time = time.time()
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self.start_times[run_id] = time.time()
 
-    def on_llm_end(self, response, *args, **kwargs):
+    def on_chat_model_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self.start_times[run_id] = time.time()
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
         token_usage = response.llm_output["token_usage"]
         self.input_tokens += token_usage["prompt_tokens"]
         self.output_tokens += token_usage["completion_tokens"]
         self.cnt += 1
-        self.all_times.append(round(time.time() - self.start_time, 2))
+        start_time = self.start_times.pop(run_id, time.time())
+        self.all_times.append(round(time.time() - start_time, 2))
 
     def reset(self) -> None:
         self.cnt = 0
@@ -55,10 +62,18 @@ class AsyncStatsCallbackHandler(AsyncCallbackHandler):
         self.stream = stream
         self.all_times = []
         self.additional_fields = {}
-        self.start_time = 0
+        # start time of each in-flight LLM call, keyed by its run_id
+        self.start_times: dict[UUID, float] = {}
+
+    async def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self.start_times[run_id] = time.time()
+        if self.stream:
+            # same as on_chat_model_start, but for non-chat LLMs
+            self.cnt += 1
+            self.input_tokens += len(self.encoder.encode(prompts[0]))
 
-    async def on_chat_model_start(self, serialized, prompts, **kwargs):
-        self.start_time = time.time()
+    async def on_chat_model_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self.start_times[run_id] = time.time()
         if self.stream:
             # if streaming mode, on_llm_end response is not collected
             # therefore, we need to count input token based on the
@@ -73,8 +88,9 @@ class AsyncStatsCallbackHandler(AsyncCallbackHandler):
             # number of streamed out tokens
             self.output_tokens += 1
 
-    async def on_llm_end(self, response, *args, **kwargs):
-        self.all_times.append(round(time.time() - self.start_time, 2))
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        start_time = self.start_times.pop(run_id, time.time())
+        self.all_times.append(round(time.time() - start_time, 2))
         if not self.stream:
             # if not streaming mode, on_llm_end response is collected
             # so we can use this stats directly
@@ -83,6 +99,13 @@ class AsyncStatsCallbackHandler(AsyncCallbackHandler):
             self.output_tokens += token_usage["completion_tokens"]
             self.cnt += 1
 
+    async def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        # e.g. a streaming joinner is cancelled as soon as its action is generated,
+        # so on_llm_end is never called
+        start_time = self.start_times.pop(run_id, None)
+        if start_time is not None:
+            self.all_times.append(round(time.time() - start_time, 2))
+
     def reset(self) -> None:
         self.cnt = 0
         self.input_tokens = 0
@@ -98,3 +121,59 @@ class AsyncStatsCallbackHandler(AsyncCallbackHandler):
             "all_times": self.all_times,
             **self.additional_fields,
         }
+
+
+class ToolStatsCollector:
+    """Collect per-tool stats of the tasks run by the TaskFetchingUnit."""
+
+    def __init__(self) -> None:
+        self.tool_stats: dict[str, dict[str, Any]] = {}
+
+    def _get_tool_stats(self, tool_name: str) -> dict[str, Any]:
+        if tool_name not in self.tool_stats:
+            self.tool_stats[tool_name] = {
+                "errors": 0,
+                "retries": 0,
+                "hedges": 0,
+                "cache_hits": 0,
+                "reuses": 0,
+                "queue_wait_times": [],
+                "all_times": [],
+            }
+        return self.tool_stats[tool_name]
+
+    def on_tool_queue_end(self, tool_name: str, wait_time: float) -> None:
+        """Called once a task got through the limits of its tool."""
+        self._get_tool_stats(tool_name)["queue_wait_times"].append(
+            round(wait_time, 2)
+        )
+
+    def on_tool_error(self, tool_name: str) -> None:
+        """Called when a task raised or timed out."""
+        self._get_tool_stats(tool_name)["errors"] += 1
+
+    def on_tool_retry(self, tool_name: str) -> None:
+        self._get_tool_stats(tool_name)["retries"] += 1
+
+    def on_tool_hedge(self, tool_name: str) -> None:
+        self._get_tool_stats(tool_name)["hedges"] += 1
+
+    def on_tool_cache_hit(self, tool_name: str) -> None:
+        """Called when a task is served from the tool result cache."""
+        self._get_tool_stats(tool_name)["cache_hits"] += 1
+
+    def on_tool_reuse(self, tool_name: str) -> None:
+        """Called when a task is served from a previous plan of the query."""
+        self._get_tool_stats(tool_name)["reuses"] += 1
+
+    def on_tool_end(self, tool_name: str, run_time: float) -> None:
+        self._get_tool_stats(tool_name)["all_times"].append(round(run_time, 2))
+
+    def reset(self) -> None:
+        self.tool_stats = {}
+
+    def get_stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            tool_name: {"calls": len(stats["all_times"]), **stats}
+            for tool_name, stats in self.tool_stats.items()
+        }
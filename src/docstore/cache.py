@@ -0,0 +1,149 @@
+"""Persistent on-disk cache for docstore search observations."""
+
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+def normalize_entity(entity: str) -> str:
+    """Normalize an entity so that trivially different queries share an entry,
+    e.g. " Barack  Obama" and "barack obama"."""
+    return " ".join(str(entity).split()).lower()
+
+
+class SearchCache:
+    """SQLite-backed cache of search observations with TTL and LRU eviction.
+
+    Entries older than `ttl` seconds are treated as misses, and once the cache
+    holds more than `max_entries` entries, the least recently used ones are evicted.
+
+    In `read_only` mode (replay), the cache is never written, and TTL is ignored,
+    so that a previous run can be replayed exactly. Misses are still served by
+    the underlying docstore, but are not stored.
+
+    A hit is a single read: the LRU access times of the hits are kept in memory,
+    and written along with the next `put` (or `flush`), so that hits never wait
+    for a commit. Use `aget` and `aput` from async code, which run in a thread so
+    that the disk I/O does not block the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = 100_000,
+        read_only: bool = False,
+    ) -> None:
+        """
+        Args:
+            path: Path to the SQLite database file.
+            ttl: Time-to-live of an entry in seconds. None means no expiration.
+            max_entries: Max number of entries to keep. None means unbounded.
+            read_only: Whether to only serve entries from an existing cache.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        # key -> last access time of the hits not written yet
+        self._pending_accesses: Dict[str, float] = {}
+
+        # the sync search path and `aget`/`aput` run in executor threads
+        self._lock = threading.Lock()
+        if read_only:
+            self._conn = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache ("
+                "key TEXT PRIMARY KEY, value TEXT, created_at REAL, last_access REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS search_cache_last_access "
+                "ON search_cache (last_access)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is not None and not self.read_only:
+                if self.ttl is not None and now - row[1] > self.ttl:
+                    # overwritten by the next put of the key
+                    row = None
+                else:
+                    self._pending_accesses[key] = now
+
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        if self.read_only:
+            return
+        with self._lock:
+            self._write_accesses()
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.max_entries is not None:
+                # evict the least recently used entries
+                self._conn.execute(
+                    "DELETE FROM search_cache WHERE key IN ("
+                    "SELECT key FROM search_cache ORDER BY last_access DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    async def aget(self, key: str) -> Optional[str]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def aput(self, key: str, value: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, value)
+
+    def _write_accesses(self) -> None:
+        if self._pending_accesses:
+            self._conn.executemany(
+                "UPDATE search_cache SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self._pending_accesses.items()],
+            )
+            self._pending_accesses.clear()
+
+    def flush(self) -> None:
+        """Write the access times of the hits since the last write."""
+        if self.read_only:
+            return
+        with self._lock:
+            self._write_accesses()
+            self._conn.commit()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        num_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+        }
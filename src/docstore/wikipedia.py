@@ -1,8 +1,13 @@
 """Wrapper around wikipedia API."""
 
 import ast
+import asyncio
+import importlib.util
 import time
-from typing import List, Optional, Union
+import weakref
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
 
 import aiohttp
 import requests
@@ -10,6 +15,8 @@ from bs4 import BeautifulSoup
 from langchain.docstore.base import Docstore
 from langchain.docstore.document import Document
 
+from src.docstore.cache import SearchCache, normalize_entity
+
 
 def clean_str(p):
     try:
@@ -19,30 +26,169 @@ def clean_str(p):
         return p
 
 
+def _get_html_parser(html_parser: str) -> str:
+    """Fall back to the builtin parser if the requested one is not installed."""
+    if html_parser == "lxml" and importlib.util.find_spec("lxml") is None:
+        print("WARNING: lxml is not installed. Falling back to html.parser.")
+        return "html.parser"
+    return html_parser
+
+
+def parse_response(
+    response_text: str, html_parser: str = "html.parser"
+) -> Tuple[Optional[List[str]], Optional[str]]:
+    """Parse the HTML of a Wikipedia search response.
+    This is a module-level function so that it can run in a process pool.
+
+    Returns:
+        (result_titles, None) if the search did not match a page,
+        (None, page) if it matched a page, where page is the cleaned page text,
+        (None, None) if the entity is ambiguous (i.e. a disambiguation page).
+    """
+    soup = BeautifulSoup(response_text, features=html_parser)
+    result_divs = soup.find_all("div", {"class": "mw-search-result-heading"})
+
+    if result_divs:  # mismatch
+        return [clean_str(div.get_text().strip()) for div in result_divs], None
+
+    paragraphs = [
+        p.get_text().strip() for p in soup.find_all("p") + soup.find_all("ul")
+    ]
+    if any("may refer to:" in p for p in paragraphs):
+        return None, None
+
+    page = ""
+    for p in paragraphs:
+        if len(p.split(" ")) > 2:
+            page += clean_str(p)
+            if not p.endswith("\n"):
+                page += "\n"
+    return None, page
+
+
 class ReActWikipedia(Docstore):
-    """Wrapper around wikipedia API."""
-
-    def __init__(self, benchmark=False, skip_retry_when_postprocess=False) -> None:
-        """Check that wikipedia package is installed."""
-        try:
-            import requests
-            from bs4 import BeautifulSoup
-        except ImportError:
+    """Wrapper around wikipedia API.
+
+    Async searches share a pooled aiohttp session owned by the docstore, so parallel
+    searches reuse connections instead of paying TCP/TLS setup every time.
+    The session is created lazily and should be closed with `aclose()`
+    (or by using the docstore as an async context manager).
+
+    HTML post-processing of async searches runs in `executor` (the default thread
+    pool of the event loop if not given). Pass a ProcessPoolExecutor to parse
+    pages in parallel across processes.
+    """
+
+    # all live instances, so that their sessions can be closed at shutdown
+    _instances: "weakref.WeakSet[ReActWikipedia]" = weakref.WeakSet()
+
+    def __init__(
+        self,
+        benchmark=False,
+        skip_retry_when_postprocess=False,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+        executor: Optional[Executor] = None,
+        html_parser: str = "html.parser",
+    ) -> None:
+        """Check that wikipedia package is installed.
+
+        Args:
+            connection_limit: Max number of simultaneous connections in the pool.
+            connection_limit_per_host: Max number of simultaneous connections
+                to the same host.
+            keepalive_timeout: Seconds to keep idle connections alive for reuse.
+            dns_cache_ttl: Seconds to cache DNS resolutions.
+            executor: Thread or process pool to run the HTML post-processing in.
+            html_parser: BeautifulSoup parser backend, e.g. "html.parser" or
+                the faster "lxml" if installed.
+        """
+        if importlib.util.find_spec("bs4") is None:
             raise ImportError(
                 "Could not import wikipedia python package. "
                 "Please install it with `pip install wikipedia`."
             )
-        self.page = None
-        self.lookup_keyword = None
-        self.lookup_list = None
-        self.lookup_cnt = None
-
         self.benchmark = benchmark
         self.all_times = []
 
         # when True, always skip retry when postprocess
         self.skip_retry_when_postprocess = skip_retry_when_postprocess
 
+        # connection pooling
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._requests_session = requests.Session()
+        ReActWikipedia._instances.add(self)
+
+        self.executor = executor
+        self.html_parser = _get_html_parser(html_parser)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled session, (re)creating it if it is closed or
+        belongs to a different event loop."""
+        loop = asyncio.get_running_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            self._discard_session()
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    def _discard_session(self) -> None:
+        """Close the session of another event loop, which cannot be awaited from
+        the current one."""
+        session, session_loop = self._session, self._session_loop
+        self._session = None
+        self._session_loop = None
+        if session is None or session.closed:
+            return
+        if session_loop is not None and session_loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+        else:
+            print(
+                "WARNING: Discarding a Wikipedia session of an event loop that is "
+                "no longer running, without closing its connections. "
+                "Call aclose() before the event loop ends."
+            )
+
+    async def _aget(self, url: str) -> str:
+        async with self._get_session().get(url) as response:
+            return await response.text()
+
+    async def aclose(self) -> None:
+        """Close the pooled session."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    @classmethod
+    async def aclose_all(cls) -> None:
+        """Close the pooled sessions of all live instances."""
+        for instance in list(cls._instances):
+            await instance.aclose()
+
+    async def __aenter__(self) -> "ReActWikipedia":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
     def reset(self):
         self.all_times = []
 
@@ -75,35 +221,29 @@ class ReActWikipedia(Docstore):
                 break
         return alternative
 
+    def _process_parsed_response(
+        self, result_titles: Optional[List[str]], page: Optional[str], entity: str
+    ) -> Optional[str]:
+        """Build the observation from the output of `parse_response`.
+        Returns None if the entity is ambiguous, in which case the caller retries.
+        This does not keep any state, as the docstore is shared by concurrent searches.
+        """
+        if result_titles is not None:  # mismatch
+            return f"Could not find {entity}. Similar: {result_titles[:5]}."
+        if page is None:  # ambiguous
+            return None
+        return self._get_page_obs(page)
+
     def post_process(
         self, response_text: str, entity: str, skip_retry_when_postprocess: bool = False
     ) -> str:
-        soup = BeautifulSoup(response_text, features="html.parser")
-        result_divs = soup.find_all("div", {"class": "mw-search-result-heading"})
-
-        if result_divs:  # mismatch
-            self.result_titles = [
-                clean_str(div.get_text().strip()) for div in result_divs
-            ]
-            obs = f"Could not find {entity}. Similar: {self.result_titles[:5]}."
-        else:
-            page = [
-                p.get_text().strip() for p in soup.find_all("p") + soup.find_all("ul")
-            ]
-            if any("may refer to:" in p for p in page):
-                if skip_retry_when_postprocess or self.skip_retry_when_postprocess:
-                    obs = "Could not find " + entity + "."
-                else:
-                    obs = self.search("[" + entity + "]", is_retry=True)
+        result_titles, page = parse_response(response_text, self.html_parser)
+        obs = self._process_parsed_response(result_titles, page, entity)
+        if obs is None:
+            if skip_retry_when_postprocess or self.skip_retry_when_postprocess:
+                obs = "Could not find " + entity + "."
             else:
-                self.page = ""
-                for p in page:
-                    if len(p.split(" ")) > 2:
-                        self.page += clean_str(p)
-                        if not p.endswith("\n"):
-                            self.page += "\n"
-                obs = self._get_page_obs(self.page)
-                self.lookup_keyword = self.lookup_list = self.lookup_cnt = None
+                obs = self.search("[" + entity + "]", is_retry=True)
 
         obs = obs.replace("\\n", "")
         return obs
@@ -111,32 +251,17 @@ class ReActWikipedia(Docstore):
     async def apost_process(
         self, response_text: str, entity: str, skip_retry_when_postprocess: bool = False
     ) -> str:
-        soup = BeautifulSoup(response_text, features="html.parser")
-        result_divs = soup.find_all("div", {"class": "mw-search-result-heading"})
-
-        if result_divs:  # mismatch
-            self.result_titles = [
-                clean_str(div.get_text().strip()) for div in result_divs
-            ]
-            obs = f"Could not find {entity}. Similar: {self.result_titles[:5]}."
-        else:
-            page = [
-                p.get_text().strip() for p in soup.find_all("p") + soup.find_all("ul")
-            ]
-            if any("may refer to:" in p for p in page):
-                if skip_retry_when_postprocess or self.skip_retry_when_postprocess:
-                    obs = "Could not find " + entity + "."
-                else:
-                    obs = await self.asearch("[" + entity + "]", is_retry=True)
+        # HTML parsing is CPU heavy for large pages, so run it in the worker pool
+        # instead of blocking the event loop (and all the other in-flight tasks)
+        result_titles, page = await asyncio.get_running_loop().run_in_executor(
+            self.executor, parse_response, response_text, self.html_parser
+        )
+        obs = self._process_parsed_response(result_titles, page, entity)
+        if obs is None:
+            if skip_retry_when_postprocess or self.skip_retry_when_postprocess:
+                obs = "Could not find " + entity + "."
             else:
-                self.page = ""
-                for p in page:
-                    if len(p.split(" ")) > 2:
-                        self.page += clean_str(p)
-                        if not p.endswith("\n"):
-                            self.page += "\n"
-                obs = self._get_page_obs(self.page)
-                self.lookup_keyword = self.lookup_list = self.lookup_cnt = None
+                obs = await self.asearch("[" + entity + "]", is_retry=True)
 
         obs = obs.replace("\\n", "")
         return obs
@@ -156,7 +281,7 @@ class ReActWikipedia(Docstore):
         entity = str(entity)
         entity_ = entity.replace(" ", "+")
         search_url = f"https://en.wikipedia.org/w/index.php?search={entity_}"
-        response_text = requests.get(search_url).text
+        response_text = self._requests_session.get(search_url).text
 
         result = self.post_process(response_text, entity)
 
@@ -164,7 +289,7 @@ class ReActWikipedia(Docstore):
             alternative = self._get_alternative(result)
             entity_ = alternative.replace(" ", "+")
             search_url = f"https://en.wikipedia.org/w/index.php?search={entity_}"
-            response_text = requests.get(search_url).text
+            response_text = self._requests_session.get(search_url).text
 
             result = self.post_process(
                 response_text, entity, skip_retry_when_postprocess=True
@@ -196,10 +321,7 @@ class ReActWikipedia(Docstore):
         entity = str(entity)
         entity_ = entity.replace(" ", "+")
         search_url = f"https://en.wikipedia.org/w/index.php?search={entity_}"
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(search_url) as response:
-                response_text = await response.text()
+        response_text = await self._aget(search_url)
 
         result = await self.apost_process(response_text, entity)
 
@@ -207,9 +329,7 @@ class ReActWikipedia(Docstore):
             alternative = self._get_alternative(result)
             entity_ = alternative.replace(" ", "+")
             search_url = f"https://en.wikipedia.org/w/index.php?search={entity_}"
-            async with aiohttp.ClientSession() as session:
-                async with session.get(search_url) as response:
-                    response_text = await response.text()
+            response_text = await self._aget(search_url)
 
             result = await self.apost_process(
                 response_text, entity, skip_retry_when_postprocess=True
@@ -225,46 +345,126 @@ class ReActWikipedia(Docstore):
         return result
 
 
+@dataclass(frozen=True)
+class SearchResult:
+    """Result of a single search. Immutable, so it can be shared safely."""
+
+    observation: str
+    document: Optional[Document] = None
+
+
 # TODO: Move this to proper place
 class DocstoreExplorer:
-    """Class to assist with exploration of a document store."""
+    """Class to assist with exploration of a document store.
+
+    Searches do not keep any state on the explorer, so a single instance can be
+    shared by many concurrent search tasks. `lookup` needs the document of the
+    previous search, so it lives in a `DocstoreSession` (see `new_session`).
+    """
+
+    def __init__(
+        self,
+        docstore: ReActWikipedia,
+        char_limit=None,
+        one_sentence=False,
+        cache: Optional[SearchCache] = None,
+    ):
+        """Initialize with a docstore.
 
-    def __init__(self, docstore: ReActWikipedia, char_limit=None, one_sentence=False):
-        """Initialize with a docstore, and set initial document to None."""
+        Args:
+            char_limit: Max number of characters of an observation.
+            one_sentence: Whether to only return the first sentence.
+                With LLMCompiler, prefer the `observation_policy` of the tool,
+                which still passes the full observation to dependent tasks.
+            cache: Optional persistent cache of the search observations.
+        """
         self.docstore = docstore
-        self.document: Optional[Document] = None
-        self.lookup_str = ""
-        self.lookup_index = 0
         self.char_limit = char_limit
         self.one_sentence = one_sentence
+        self.cache = cache
 
-    def search(self, term: str) -> str:
-        """Search for a term in the docstore, and if found save."""
-        result = self.docstore.search(term)
+    def new_session(self) -> "DocstoreSession":
+        """Create a session with its own lookup state."""
+        return DocstoreSession(self)
+
+    def _cache_key(self, term: str) -> str:
+        # the observation depends on the truncation settings as well
+        return (
+            f"{normalize_entity(term)}"
+            f"|char_limit={self.char_limit}|one_sentence={self.one_sentence}"
+        )
+
+    def _postprocess_result(self, result: Union[str, Document]) -> SearchResult:
+        document = None
+        if isinstance(result, Document):
+            document = result
+            result = _get_paragraphs(document)[0]
         if self.one_sentence:
             result = result.split(". ")[0]
         if self.char_limit is not None:
             result = result[: self.char_limit]
-        if isinstance(result, Document):
-            self.document = result
-            return self._summary
-        else:
-            self.document = None
-            return result
+        return SearchResult(observation=result, document=document)
+
+    def search_result(self, term: str, require_document: bool = False) -> SearchResult:
+        """Search for a term in the docstore.
+
+        Args:
+            require_document: Whether the document is needed, e.g. for `lookup`.
+                The cache only stores the observations, so it is not read then.
+        """
+        if self.cache is not None and not require_document:
+            cached = self.cache.get(self._cache_key(term))
+            if cached is not None:
+                return SearchResult(observation=cached)
+        result = self._postprocess_result(self.docstore.search(term))
+        if self.cache is not None:
+            self.cache.put(self._cache_key(term), result.observation)
+        return result
+
+    async def asearch_result(
+        self, term: str, require_document: bool = False
+    ) -> SearchResult:
+        """Search for a term in the docstore. See `search_result`."""
+        if self.cache is not None and not require_document:
+            cached = await self.cache.aget(self._cache_key(term))
+            if cached is not None:
+                return SearchResult(observation=cached)
+        result = self._postprocess_result(await self.docstore.asearch(term))
+        if self.cache is not None:
+            await self.cache.aput(self._cache_key(term), result.observation)
+        return result
+
+    def search(self, term: str) -> str:
+        """Search for a term in the docstore, and return the observation."""
+        return self.search_result(term).observation
+
+    async def asearch(self, term: str) -> str:
+        """Search for a term in the docstore, and return the observation."""
+        return (await self.asearch_result(term)).observation
+
+
+class DocstoreSession:
+    """Lookup state on top of a DocstoreExplorer.
+    Create one session per agent that uses `lookup`."""
+
+    def __init__(self, explorer: DocstoreExplorer):
+        """Initialize with an explorer, and set initial document to None."""
+        self.explorer = explorer
+        self.document: Optional[Document] = None
+        self.lookup_str = ""
+        self.lookup_index = 0
+
+    def search(self, term: str) -> str:
+        """Search for a term in the docstore, and if found save."""
+        result = self.explorer.search_result(term, require_document=True)
+        self.document = result.document
+        return result.observation
 
     async def asearch(self, term: str) -> str:
         """Search for a term in the docstore, and if found save."""
-        result = await self.docstore.asearch(term)
-        if self.one_sentence:
-            result = result.split(". ")[0]
-        if self.char_limit is not None:
-            result = result[: self.char_limit]
-        if isinstance(result, Document):
-            self.document = result
-            return self._summary
-        else:
-            self.document = None
-            return result
+        result = await self.explorer.asearch_result(term, require_document=True)
+        self.document = result.document
+        return result.observation
 
     def lookup(self, term: str) -> str:
         """Lookup a term in document (if saved)."""
@@ -275,7 +475,9 @@ class DocstoreExplorer:
             self.lookup_index = 0
         else:
             self.lookup_index += 1
-        lookups = [p for p in self._paragraphs if self.lookup_str in p.lower()]
+        lookups = [
+            p for p in _get_paragraphs(self.document) if self.lookup_str in p.lower()
+        ]
         if len(lookups) == 0:
             return "No Results"
         elif self.lookup_index >= len(lookups):
@@ -284,12 +486,8 @@ class DocstoreExplorer:
             result_prefix = f"(Result {self.lookup_index + 1}/{len(lookups)})"
             return f"{result_prefix} {lookups[self.lookup_index]}"
 
-    @property
-    def _summary(self) -> str:
-        return self._paragraphs[0]
 
-    @property
-    def _paragraphs(self) -> List[str]:
-        if self.document is None:
-            raise ValueError("Cannot get paragraphs without a document")
-        return self.document.page_content.split("\n\n")
+def _get_paragraphs(document: Optional[Document]) -> List[str]:
+    if document is None:
+        raise ValueError("Cannot get paragraphs without a document")
+    return document.page_content.split("\n\n")
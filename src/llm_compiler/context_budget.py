@@ -0,0 +1,117 @@
+"""Token budget of the per-request content of the planner and joinner prompts."""
+
+from typing import Dict, List, Mapping, Optional, Sequence
+
+import tiktoken
+
+from src.llm_compiler.task_fetching_unit import Task
+
+TRUNCATED = " ...(truncated)"
+OMITTED = "...(earlier results omitted)\n"
+
+
+class ContextBudget:
+    """Bounds the observations that are fed back to the LLMs, so that the prompts
+    do not grow with every replan.
+
+    Each observation is truncated to `max_observation_tokens`, and an observation
+    identical to an earlier one of the same query is replaced by a reference to
+    the call that returned it, e.g. "same as search(Ed Wood)", as the indices of
+    the actions are not shown to the joinner and restart on every replan. The
+    previous plans in the replanner context and the results in the joinner
+    scratchpad are then bounded to `max_tokens`, keeping the most recent ones.
+    The static prompt prefix and the question come on top of the budget.
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_observation_tokens: Optional[int] = None,
+    ) -> None:
+        """
+        Args:
+            max_tokens: Max tokens of the previous plans in the replanner prompt,
+                and of the results in the joinner prompt. None means unbounded.
+            max_observation_tokens: Max tokens of a single observation.
+                None means unbounded.
+        """
+        self.max_tokens = max_tokens
+        self.max_observation_tokens = max_observation_tokens
+        # same for gpt-3.5
+        self.encoder = tiktoken.encoding_for_model("gpt-4")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoder.encode(text))
+
+    def _truncate_head(self, text: str, max_tokens: int) -> str:
+        """Keeps the beginning of the text."""
+        tokens = self.encoder.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.encoder.decode(tokens[:max_tokens]).rstrip() + TRUNCATED
+
+    def _truncate_tail(self, text: str, max_tokens: int) -> str:
+        """Keeps the end of the text, from the first complete line."""
+        tokens = self.encoder.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        max_tokens = max(max_tokens - self.count_tokens(OMITTED), 0)
+        text = self.encoder.decode(tokens[len(tokens) - max_tokens :])
+        return OMITTED + text[text.find("\n") + 1 :]
+
+    def compact_observations(
+        self,
+        tasks: Mapping[int, Task],
+        seen: Dict[str, str],
+        observations: Optional[Mapping[int, str]] = None,
+    ) -> Dict[int, str]:
+        """Observations of the tasks, truncated and deduplicated.
+
+        Args:
+            tasks: Tasks to get the observations of.
+            seen: Observations of the query so far -> call of their first task.
+                Updated with the observations of the tasks.
+            observations: Observations to use instead of those of the tasks,
+                e.g. already compressed.
+
+        Returns:
+            idx of the task -> observation.
+        """
+        given_observations = observations or {}
+        observations = {}
+        for task in tasks.values():
+            if task.is_join or task.observation is None:
+                continue
+            observation = given_observations.get(task.idx)
+            if observation is None:
+                observation = task.get_observation_str()
+            if observation in seen:
+                reference = f"same as {seen[observation]}"
+                if len(reference) < len(observation):
+                    observations[task.idx] = reference
+                    continue
+            seen.setdefault(observation, task.get_action_str())
+            if self.max_observation_tokens is not None:
+                observation = self._truncate_head(
+                    observation, self.max_observation_tokens
+                )
+            observations[task.idx] = observation
+        return observations
+
+    def fit(self, blocks: Sequence[str]) -> List[str]:
+        """Drops the oldest blocks so that the blocks fit in `max_tokens`. The most
+        recent block is truncated instead if it does not fit by itself."""
+        if self.max_tokens is None:
+            return list(blocks)
+        fitted = []
+        num_tokens = 0
+        for block in reversed(blocks):
+            block_tokens = self.count_tokens(block)
+            if num_tokens + block_tokens > self.max_tokens:
+                if not fitted:
+                    # always keep the most recent results, even if truncated
+                    fitted.append(self._truncate_tail(block, self.max_tokens))
+                break
+            fitted.append(block)
+            num_tokens += block_tokens
+        return fitted[::-1]
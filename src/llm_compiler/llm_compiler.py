@@ -1,6 +1,8 @@
 import asyncio
+from contextvars import ContextVar
 from typing import Any, Dict, List, Mapping, Optional, Sequence, Union, cast
 
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.callbacks.manager import (
     AsyncCallbackManagerForChainRun,
     CallbackManagerForChainRun,
@@ -10,27 +12,108 @@ from langchain.llms import BaseLLM
 from langchain.llms.base import BaseLLM
 from langchain.prompts.base import StringPromptValue
 
-from src.callbacks.callbacks import AsyncStatsCallbackHandler
+from src.callbacks.callbacks import AsyncStatsCallbackHandler, ToolStatsCollector
 from src.chains.chain import Chain
 from src.llm_compiler.constants import JOINNER_REPLAN
+from src.llm_compiler.context_budget import ContextBudget
+from src.llm_compiler.observation_compressor import ObservationCompressor
+from src.llm_compiler.plan_cache import PlanCache, PlanTemplateCache
 from src.llm_compiler.planner import Planner
-from src.llm_compiler.task_fetching_unit import Task, TaskFetchingUnit
+from src.llm_compiler.prompt_prefix import PromptPrefix
+from src.llm_compiler.task_fetching_unit import (
+    Task,
+    TaskFetchingUnit,
+    ToolLatencyTracker,
+)
+from src.llm_compiler.tool_cache import ToolResultCache
 from src.tools.base import StructuredTool, Tool
 from src.utils.logger_utils import log
 
 
+class JoinnerStreamingCallback(AsyncCallbackHandler):
+    """Collects the streamed joinner output and detects when the Action line,
+    i.e. `Action: Finish(...)` or `Action: Replan(...)`, is complete."""
+
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.action_done = asyncio.Event()
+
+    def _is_action_complete(self) -> bool:
+        action_start = self.buffer.find("Action:")
+        if action_start == -1:
+            return False
+        action = self.buffer[action_start:]
+        if "\n" in action:
+            return True
+        # same as `_parse_joinner_output`, the answer ends at the first ")"
+        open_paren = action.find("(")
+        return open_paren != -1 and action.find(")", open_paren) != -1
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.action_done.is_set():
+            return
+        self.buffer += token
+        if self._is_action_complete():
+            self.action_done.set()
+
+
 class LLMCompilerAgent:
     """Self defined agent for LLM Compiler."""
 
-    def __init__(self, llm: BaseLLM) -> None:
+    def __init__(self, llm: BaseLLM, stream: bool = False) -> None:
+        """
+        Args:
+            stream: Whether to stream the output, and return as soon as the
+                Action line is complete instead of waiting for the trailing tokens.
+                The llm must be created with streaming enabled.
+        """
         self.llm = llm
+        self.stream = stream
 
     async def arun(self, prompt: str, callbacks=None) -> str:
+        if self.stream:
+            return await self._arun_streaming(prompt, callbacks=callbacks)
+
         response = await self.llm.agenerate_prompt(
             prompts=[StringPromptValue(text=prompt)],
             stop=["<END_OF_RESPONSE>"],
             callbacks=callbacks,
         )
+        return self._get_text(response)
+
+    async def _arun_streaming(self, prompt: str, callbacks=None) -> str:
+        streaming_callback = JoinnerStreamingCallback()
+        generation = asyncio.create_task(
+            self.llm.agenerate_prompt(
+                prompts=[StringPromptValue(text=prompt)],
+                stop=["<END_OF_RESPONSE>"],
+                callbacks=[streaming_callback] + (callbacks or []),
+            )
+        )
+        action_done = asyncio.create_task(streaming_callback.action_done.wait())
+        done, _ = await asyncio.wait(
+            {generation, action_done}, return_when=asyncio.FIRST_COMPLETED
+        )
+        if generation in done:
+            action_done.cancel()
+            return self._get_text(generation.result())
+
+        # Finish/Replan is already known, so don't wait for the trailing tokens
+        log("Joinner action detected, stop streaming.")
+        generation.cancel()
+        # let the cancellation go through the callbacks before returning
+        await asyncio.gather(generation, return_exceptions=True)
+        return streaming_callback.buffer
+
+    async def aprefill(self, prompt: str) -> None:
+        """Request a single token for the prompt, so that the server computes and
+        caches its prefill, i.e. its KV cache with vLLM or OpenAI prefix caching,
+        before the actual request with a prompt that extends it."""
+        await self.llm.agenerate_prompt(
+            prompts=[StringPromptValue(text=prompt)], max_tokens=1
+        )
+
+    def _get_text(self, response) -> str:
         if isinstance(self.llm, BaseChatModel):
             return response.generations[0][0].message.content
 
@@ -60,6 +143,16 @@ class LLMCompiler(Chain, extra="allow"):
         joinner_prompt_final: Optional[str],
         max_replans: int,
         benchmark: bool,
+        joinner_stream: bool = False,
+        join_prefill: bool = False,
+        typed_observations: bool = False,
+        task_timeout: Optional[float] = None,
+        plan_timeout: Optional[float] = None,
+        tool_cache: Optional[ToolResultCache] = None,
+        plan_cache: Optional[PlanCache] = None,
+        plan_template_cache: Optional[PlanTemplateCache] = None,
+        context_budget: Optional[ContextBudget] = None,
+        observation_compressor: Optional[ObservationCompressor] = None,
         **kwargs,
     ) -> None:
         """
@@ -67,6 +160,28 @@ class LLMCompiler(Chain, extra="allow"):
             tools: List of tools to use.
             max_replans: Maximum number of replans to do.
             benchmark: Whether to collect benchmark stats.
+            typed_observations: Whether to pass the raw observation of a task to
+                an argument that is exactly a reference to it, e.g. "$1", instead of
+                its string.
+            task_timeout: Default max seconds a task can take to run, for the tools
+                that do not declare their own timeout.
+            plan_timeout: Max seconds to run the tasks of a plan.
+                Tasks that fail or time out get an error observation, so that the
+                joinner can still answer or replan.
+            tool_cache: Memoizes the results of the tools across plans and queries,
+                so that identical tool calls are made only once.
+            plan_cache: Caches the first plan of each question, so that repeated
+                questions skip the planner.
+            plan_template_cache: Reuses the first plan of each question for
+                questions that only differ in their entities, so that templated
+                questions skip the planner.
+            context_budget: Bounds the observations and previous plans fed back
+                to the joinner and the replanner, so that their prompts do not grow
+                with every replan.
+            observation_compressor: Reduces the observations fed back to the
+                joinner and the replanner to the sentences relevant to the
+                question. The `observation_policy` of the tools applies even
+                without it.
 
         Planner Args:
             planner_llm: LLM to use for planning.
@@ -82,6 +197,13 @@ class LLMCompiler(Chain, extra="allow"):
             joinner_prompt: Prompt to use for joinner.
             joinner_prompt_final: Prompt to use for joinner at the final replanning iter.
                 If not assigned, default to `joinner_prompt`.
+            joinner_stream: Whether to stream the joinner output, and finish or
+                replan as soon as its Action is generated.
+                `agent_llm` must be created with streaming enabled.
+            join_prefill: Whether to prefill the joinner prompt with the results
+                known so far while the tasks of a plan run, so that the join only
+                prefills the results of the plan. Requires a server with prefix
+                caching, e.g. vLLM with `--enable-prefix-caching`.
         """
         super().__init__(**kwargs)
 
@@ -99,37 +221,152 @@ class LLMCompiler(Chain, extra="allow"):
             stop=planner_stop,
         )
 
-        self.agent = LLMCompilerAgent(agent_llm)
+        self.agent = LLMCompilerAgent(agent_llm, stream=joinner_stream)
+        self.joinner_stream = joinner_stream
+        self.join_prefill = join_prefill
         self.joinner_prompt = joinner_prompt
         self.joinner_prompt_final = joinner_prompt_final or joinner_prompt
+        # the joinner prompts are the static prefixes of every joinner request
+        self.joinner_prompt_prefix = PromptPrefix(self.joinner_prompt, separator="\n")
+        self.joinner_prompt_prefix_final = PromptPrefix(
+            self.joinner_prompt_final, separator="\n"
+        )
         self.planner_stream = planner_stream
         self.max_replans = max_replans
+        self.typed_observations = typed_observations
+        self.task_timeout = task_timeout
+        self.plan_timeout = plan_timeout
+        # latency of the tools across queries, to prioritize the critical path
+        self.latency_tracker = ToolLatencyTracker()
+        self.tool_cache = tool_cache
+        self.plan_cache = plan_cache
+        self.plan_template_cache = plan_template_cache
+        self.context_budget = context_budget
+        self.observation_policies = {
+            tool.name: tool.observation_policy for tool in tools
+        }
+        if observation_compressor is None and any(self.observation_policies.values()):
+            # only apply the observation policies of the tools
+            observation_compressor = ObservationCompressor(
+                max_sentences=None, select_relevant=False, dedup=False
+            )
+        self.observation_compressor = observation_compressor
 
         # callbacks
         self.benchmark = benchmark
-        if benchmark:
-            self.planner_callback = AsyncStatsCallbackHandler(stream=planner_stream)
-            self.executor_callback = AsyncStatsCallbackHandler(stream=False)
-        else:
-            self.planner_callback = None
-            self.executor_callback = None
+        # (planner_callback, executor_callback, tool_stats) of the invocation
+        # running in the current context. Every `_acall` installs fresh handlers,
+        # so concurrent queries (each in its own asyncio task) never share
+        # counters, and the stats of a query can be queried by its caller after
+        # the call returns.
+        self.stats_callbacks: ContextVar[
+            Optional[
+                tuple[
+                    AsyncStatsCallbackHandler,
+                    AsyncStatsCallbackHandler,
+                    ToolStatsCollector,
+                ]
+            ]
+        ] = ContextVar(f"llm_compiler_stats_callbacks_{id(self)}", default=None)
+
+    @property
+    def planner_callback(self) -> Optional[AsyncStatsCallbackHandler]:
+        stats_callbacks = self.stats_callbacks.get()
+        return stats_callbacks[0] if stats_callbacks else None
+
+    @property
+    def executor_callback(self) -> Optional[AsyncStatsCallbackHandler]:
+        stats_callbacks = self.stats_callbacks.get()
+        return stats_callbacks[1] if stats_callbacks else None
+
+    @property
+    def tool_stats(self) -> Optional[ToolStatsCollector]:
+        stats_callbacks = self.stats_callbacks.get()
+        return stats_callbacks[2] if stats_callbacks else None
+
+    def _init_stats(self):
+        """Install fresh stats handlers for the invocation in the current context."""
+        if self.benchmark:
+            planner_callback = AsyncStatsCallbackHandler(stream=self.planner_stream)
+            planner_callback.additional_fields["num_tasks"] = 0
+            planner_callback.additional_fields["num_replans"] = 0
+            planner_callback.additional_fields["prefix_cache_eligible_tokens"] = 0
+            planner_callback.additional_fields["plan_cache_hits"] = 0
+            planner_callback.additional_fields["plan_template_hits"] = 0
+            planner_callback.additional_fields["plan_cache_saved_tokens"] = 0
+            executor_callback = AsyncStatsCallbackHandler(stream=self.joinner_stream)
+            executor_callback.additional_fields["prefix_cache_eligible_tokens"] = 0
+            tool_stats = ToolStatsCollector()
+            self.stats_callbacks.set((planner_callback, executor_callback, tool_stats))
 
     def get_all_stats(self):
+        """Stats of the last invocation made from the current context."""
         stats = {}
-        if self.benchmark:
+        if self.benchmark and self.planner_callback:
             stats["planner"] = self.planner_callback.get_stats()
             stats["executor"] = self.executor_callback.get_stats()
             stats["total"] = {
                 k: v + stats["executor"].get(k, 0) for k, v in stats["planner"].items()
             }
+            stats["tools"] = self.tool_stats.get_stats()
+            if self.plan_cache is not None:
+                # across all the queries
+                stats["plan_cache"] = self.plan_cache.get_stats()
+            if self.plan_template_cache is not None:
+                stats["plan_template_cache"] = self.plan_template_cache.get_stats()
 
         return stats
 
+    def _get_planner_tokens(self) -> int:
+        """Tokens used by the planner so far in the current invocation."""
+        if not self.benchmark:
+            return 0
+        return self.planner_callback.input_tokens + self.planner_callback.output_tokens
+
+    async def _get_cached_plan(
+        self, question: str
+    ) -> Optional[tuple[Dict[int, Task], int]]:
+        """Tasks of a cached plan of the question and the planner tokens it
+        saves, from the plan cache first and then the plan template cache."""
+        prompt_version = self.planner.prompt_version
+        if self.plan_cache is not None:
+            key = self.plan_cache.make_key(question, prompt_version)
+            cached_plan = await self.plan_cache.get(key, self.planner.tools)
+            if cached_plan is not None:
+                log("Plan cache hit, graph of tasks: ", cached_plan[0], block=True)
+                if self.benchmark:
+                    self.planner_callback.additional_fields["plan_cache_hits"] += 1
+                return cached_plan
+        if self.plan_template_cache is not None:
+            cached_plan = self.plan_template_cache.get(
+                question, prompt_version, self.planner.tools
+            )
+            if cached_plan is not None:
+                log("Plan template hit, graph of tasks: ", cached_plan[0], block=True)
+                if self.benchmark:
+                    self.planner_callback.additional_fields["plan_template_hits"] += 1
+                return cached_plan
+        return None
+
+    async def _put_cached_plan(
+        self, question: str, tasks: Dict[int, Task], num_tokens: int
+    ) -> None:
+        prompt_version = self.planner.prompt_version
+        if self.plan_cache is not None:
+            key = self.plan_cache.make_key(question, prompt_version)
+            await self.plan_cache.put(key, tasks, num_tokens=num_tokens)
+        if self.plan_template_cache is not None:
+            self.plan_template_cache.put(
+                question, prompt_version, tasks, num_tokens=num_tokens
+            )
+
     def reset_all_stats(self):
         if self.planner_callback:
             self.planner_callback.reset()
         if self.executor_callback:
             self.executor_callback.reset()
+        if self.tool_stats:
+            self.tool_stats.reset()
 
     @property
     def input_keys(self) -> List[str]:
@@ -162,8 +399,31 @@ class LLMCompiler(Chain, extra="allow"):
                 thought = ans.split("Thought:")[1].strip()
         return thought, answer, is_replan
 
+    def _compact_observations(
+        self,
+        input_query: str,
+        tasks: Mapping[int, Task],
+        seen_sentences: Dict[str, str],
+        seen_observations: Dict[str, str],
+    ) -> Optional[Dict[int, str]]:
+        """Observations of the tasks, compressed and within the context budget,
+        if any."""
+        observations = None
+        if self.observation_compressor is not None:
+            observations = self.observation_compressor.compress(
+                input_query, tasks, self.observation_policies, seen_sentences
+            )
+        if self.context_budget is not None:
+            observations = self.context_budget.compact_observations(
+                tasks, seen_observations, observations
+            )
+        return observations
+
     def _generate_context_for_replanner(
-        self, tasks: Mapping[int, Task], joinner_thought: str
+        self,
+        tasks: Mapping[int, Task],
+        joinner_thought: str,
+        observations: Optional[Mapping[int, str]] = None,
     ) -> str:
         """Formatted like this:
         ```
@@ -178,7 +438,9 @@ class LLMCompiler(Chain, extra="allow"):
         previous_plan_and_observations = "\n".join(
             [
                 task.get_though_action_observation(
-                    include_action=True, include_action_idx=True
+                    include_action=True,
+                    include_action_idx=True,
+                    observation=observations.get(task.idx) if observations else None,
                 )
                 for task in tasks.values()
                 if not task.is_join
@@ -192,25 +454,73 @@ class LLMCompiler(Chain, extra="allow"):
         """contexts is a list of context
         each context is formatted as the description of _generate_context_for_replanner
         """
-        formatted_contexts = ""
-        for context in contexts:
-            formatted_contexts += f"Previous Plan:\n\n{context}\n\n"
+        formatted_contexts = [
+            f"Previous Plan:\n\n{context}\n\n" for context in contexts
+        ]
+        if self.context_budget is not None:
+            # keep the most recent plans
+            formatted_contexts = self.context_budget.fit(formatted_contexts)
+        formatted_contexts = "".join(formatted_contexts)
         formatted_contexts += "Current Plan:\n\n"
         return formatted_contexts
 
+    def _update_agent_scratchpad(
+        self,
+        agent_scratchpad: str,
+        tasks: Mapping[int, Task],
+        observations: Optional[Mapping[int, str]] = None,
+    ) -> str:
+        """Append the thought-action-observation of the tasks to the scratchpad."""
+        agent_scratchpad += "\n\n"
+        agent_scratchpad += "".join(
+            [
+                task.get_though_action_observation(
+                    include_action=True,
+                    include_thought=True,
+                    observation=observations.get(task.idx) if observations else None,
+                )
+                for task in tasks.values()
+                if not task.is_join
+            ]
+        )
+        return agent_scratchpad.strip()
+
+    async def _prefill_join(
+        self, input_query: str, agent_scratchpad: str, is_final: bool
+    ) -> None:
+        """Prefill the joinner prompt up to the results of the previous plans."""
+        if is_final:
+            joinner_prompt_prefix = self.joinner_prompt_prefix_final
+        else:
+            joinner_prompt_prefix = self.joinner_prompt_prefix
+        prompt = joinner_prompt_prefix.format(
+            f"Question: {input_query}\n\n{agent_scratchpad}"
+        )
+        try:
+            await self.agent.aprefill(prompt)
+        except Exception as e:
+            # only an optimization, the join does not depend on it
+            log(f"Joinner prefill failed: {e!r}")
+
     async def join(
         self, input_query: str, agent_scratchpad: str, is_final: bool
     ) -> str:
         if is_final:
-            joinner_prompt = self.joinner_prompt_final
+            joinner_prompt_prefix = self.joinner_prompt_prefix_final
         else:
-            joinner_prompt = self.joinner_prompt
-        prompt = (
-            f"{joinner_prompt}\n"  # Instructions and examples
+            joinner_prompt_prefix = self.joinner_prompt_prefix
+        if self.context_budget is not None:
+            # keep the most recent results
+            agent_scratchpad = "".join(self.context_budget.fit([agent_scratchpad]))
+        prompt = joinner_prompt_prefix.format(  # Instructions and examples
             f"Question: {input_query}\n\n"  # User input query
             f"{agent_scratchpad}\n"  # T-A-O
             # "---\n"
         )
+        if self.benchmark:
+            self.executor_callback.additional_fields[
+                "prefix_cache_eligible_tokens"
+            ] += joinner_prompt_prefix.num_tokens
         log("Joining prompt:\n", prompt, block=True)
         response = await self.agent.arun(
             prompt, callbacks=[self.executor_callback] if self.benchmark else None
@@ -236,57 +546,134 @@ class LLMCompiler(Chain, extra="allow"):
         inputs: Dict[str, Any],
         run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
     ) -> Dict[str, Any]:
+        self._init_stats()
         contexts = []
         joinner_thought = ""
         agent_scratchpad = ""
+        # sentences and observations fed back so far -> call of their first task
+        seen_sentences = {}
+        seen_observations = {}
+        # successfully completed tasks of all the previous plans
+        previous_tasks = []
         for i in range(self.max_replans):
             is_first_iter = i == 0
             is_final_iter = i == self.max_replans - 1
 
-            task_fetching_unit = TaskFetchingUnit()
-            if self.planner_stream:
-                task_queue = asyncio.Queue()
-                asyncio.create_task(
-                    self.planner.aplan(
+            task_fetching_unit = TaskFetchingUnit(
+                typed_observations=self.typed_observations,
+                tool_stats=self.tool_stats,
+                latency_tracker=self.latency_tracker,
+                task_timeout=self.task_timeout,
+                plan_timeout=self.plan_timeout,
+                tool_cache=self.tool_cache,
+                previous_tasks=previous_tasks,
+            )
+            cached_plan = None
+            if is_first_iter:
+                cached_plan = await self._get_cached_plan(inputs["input"])
+            planner_tokens = self._get_planner_tokens()
+            # whether the planner call finished without an error, in which case
+            # the plan can be cached
+            is_plan_complete = True
+            prefill_task = None
+            if self.join_prefill:
+                # runs while the planner and the tasks run, as it only depends on
+                # the results of the previous plans
+                prefill_task = asyncio.create_task(
+                    self._prefill_join(inputs["input"], agent_scratchpad, is_final_iter)
+                )
+            try:
+                if cached_plan is not None:
+                    # repeated or templated question, skip the planner
+                    tasks, saved_tokens = cached_plan
+                    if self.benchmark:
+                        self.planner_callback.additional_fields[
+                            "plan_cache_saved_tokens"
+                        ] += saved_tokens
+                    task_fetching_unit.set_tasks(tasks)
+                    await task_fetching_unit.schedule()
+                elif self.planner_stream:
+                    task_queue = asyncio.Queue()
+                    planner_task = asyncio.create_task(
+                        self.planner.aplan(
+                            inputs=inputs,
+                            task_queue=task_queue,
+                            is_replan=not is_first_iter,
+                            callbacks=(
+                                [self.planner_callback]
+                                if self.planner_callback
+                                else None
+                            ),
+                        )
+                    )
+                    try:
+                        await task_fetching_unit.aschedule(
+                            task_queue=task_queue, func=lambda x: None
+                        )
+                    except BaseException:
+                        # e.g. the query is abandoned
+                        planner_task.cancel()
+                        raise
+                    if task_fetching_unit.timed_out:
+                        # stop generating the rest of a plan that will not be executed
+                        planner_task.cancel()
+                        is_plan_complete = False
+                    else:
+                        # the end of the stream is also signaled when the planner
+                        # call fails, e.g. is cut off, so check how it finished
+                        await asyncio.wait([planner_task])
+                        if planner_task.exception() is not None:
+                            log(f"Planner failed: {planner_task.exception()!r}")
+                            is_plan_complete = False
+                else:
+                    tasks = await self.planner.plan(
                         inputs=inputs,
-                        task_queue=task_queue,
                         is_replan=not is_first_iter,
+                        # callbacks=run_manager.get_child() if run_manager else None,
                         callbacks=(
                             [self.planner_callback] if self.planner_callback else None
                         ),
                     )
-                )
-                await task_fetching_unit.aschedule(
-                    task_queue=task_queue, func=lambda x: None
-                )
-            else:
-                tasks = await self.planner.plan(
-                    inputs=inputs,
-                    is_replan=not is_first_iter,
-                    # callbacks=run_manager.get_child() if run_manager else None,
-                    callbacks=(
-                        [self.planner_callback] if self.planner_callback else None
-                    ),
-                )
-                log("Graph of tasks: ", tasks, block=True)
-                if self.benchmark:
-                    self.planner_callback.additional_fields["num_tasks"] = len(tasks)
-                task_fetching_unit.set_tasks(tasks)
-                await task_fetching_unit.schedule()
+                    log("Graph of tasks: ", tasks, block=True)
+                    task_fetching_unit.set_tasks(tasks)
+                    await task_fetching_unit.schedule()
+            finally:
+                if prefill_task is not None:
+                    # the join prefills whatever is left
+                    prefill_task.cancel()
             tasks = task_fetching_unit.tasks
+            if self.benchmark:
+                self.planner_callback.additional_fields["num_tasks"] += len(tasks)
+            if self.benchmark and cached_plan is None:
+                self.planner_callback.additional_fields[
+                    "prefix_cache_eligible_tokens"
+                ] += self.planner.get_prompt_prefix(not is_first_iter).num_tokens
+            if (
+                is_first_iter
+                and cached_plan is None
+                and is_plan_complete
+                and any(task.is_join for task in tasks.values())
+                and not task_fetching_unit.timed_out
+            ):
+                await self._put_cached_plan(
+                    inputs["input"],
+                    tasks,
+                    num_tokens=self._get_planner_tokens() - planner_tokens,
+                )
+            # so that replans never run the same tool call twice
+            previous_tasks.extend(
+                task
+                for task in tasks.values()
+                if not task.is_join and task.idx not in task_fetching_unit.failed_tasks
+            )
 
             # collect thought-action-observation
-            agent_scratchpad += "\n\n"
-            agent_scratchpad += "".join(
-                [
-                    task.get_though_action_observation(
-                        include_action=True, include_thought=True
-                    )
-                    for task in tasks.values()
-                    if not task.is_join
-                ]
+            observations = self._compact_observations(
+                inputs["input"], tasks, seen_sentences, seen_observations
+            )
+            agent_scratchpad = self._update_agent_scratchpad(
+                agent_scratchpad, tasks, observations
             )
-            agent_scratchpad = agent_scratchpad.strip()
 
             log("Agent scratchpad:\n", agent_scratchpad, block=True)
             joinner_thought, answer, is_replan = await self.join(
@@ -297,10 +684,12 @@ class LLMCompiler(Chain, extra="allow"):
             if not is_replan:
                 log("Break out of replan loop.")
                 break
+            if self.benchmark:
+                self.planner_callback.additional_fields["num_replans"] += 1
 
             # Collect contexts for the subsequent replanner
             context = self._generate_context_for_replanner(
-                tasks=tasks, joinner_thought=joinner_thought
+                tasks=tasks, joinner_thought=joinner_thought, observations=observations
             )
             contexts.append(context)
             formatted_contexts = self._format_contexts(contexts)
@@ -0,0 +1,189 @@
+"""Reduction of the tool observations fed back to the joinner and the replanner."""
+
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Mapping, Optional, Sequence
+
+from src.llm_compiler.task_fetching_unit import Task
+from src.tools.base import ObservationPolicy
+
+# paragraphs, and the ends of sentences, e.g. "... in 1961. He ..." but not "Jr. was"
+_SENTENCE_RE = re.compile(r"\n+|(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+_WORD_RE = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from has have how in is it its of on "
+    "or that the their this to was were what when where which who whom whose why "
+    "with".split()
+)
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_RE.split(text) if s.strip()]
+
+
+def _get_terms(text: str) -> List[str]:
+    return [w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def _normalize(sentence: str) -> str:
+    return " ".join(sentence.split()).lower()
+
+
+class ObservationCompressor:
+    """Reduces the observations of a plan before they are fed back to the LLMs.
+
+    For each observation, the sentences most relevant to the question and to the
+    args of its action are selected by BM25, scored against the sentences of all
+    the observations of the plan, so that no external index or network access is
+    needed. The first sentence is kept as well, as it usually introduces the
+    entity. Sentences already fed back from another action of the same query are
+    dropped, and an observation left empty is replaced by a reference to the
+    call that returned them first, e.g. "same as search(Ed Wood)". How many
+    sentences and characters to keep is set per tool by its `observation_policy`,
+    or by the default policy of the compressor.
+    """
+
+    def __init__(
+        self,
+        max_sentences: Optional[int] = 3,
+        max_chars: Optional[int] = None,
+        select_relevant: bool = True,
+        keep_first: bool = True,
+        dedup: bool = True,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> None:
+        """
+        Args:
+            max_sentences: Max number of sentences of an observation, for the tools
+                without an observation policy. None means all.
+            max_chars: Max number of characters of an observation, for the tools
+                without an observation policy. None means all.
+            select_relevant: Whether to keep the sentences most relevant to the
+                question, instead of the first ones.
+            keep_first: Whether to always keep the first sentence, which usually
+                introduces the entity, e.g. of a Wikipedia page.
+            dedup: Whether to drop sentences already fed back from another action.
+            k1: BM25 term frequency saturation.
+            b: BM25 length normalization.
+        """
+        self.default_policy = ObservationPolicy(
+            max_sentences=max_sentences, max_chars=max_chars
+        )
+        self.select_relevant = select_relevant
+        self.keep_first = keep_first
+        self.dedup = dedup
+        self.k1 = k1
+        self.b = b
+
+    def _score(
+        self,
+        query_terms: Sequence[str],
+        sentences: Sequence[List[str]],
+        document_frequencies: Counter,
+        num_sentences: int,
+        avg_length: float,
+    ) -> List[float]:
+        scores = []
+        for terms in sentences:
+            term_frequencies = Counter(terms)
+            score = 0.0
+            for term in set(query_terms):
+                tf = term_frequencies[term]
+                if not tf:
+                    continue
+                df = document_frequencies[term]
+                idf = math.log(1 + (num_sentences - df + 0.5) / (df + 0.5))
+                norm = 1 - self.b + self.b * len(terms) / avg_length
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+            scores.append(score)
+        return scores
+
+    def compress(
+        self,
+        question: str,
+        tasks: Mapping[int, Task],
+        policies: Mapping[str, Optional[ObservationPolicy]],
+        seen: Dict[str, str],
+    ) -> Dict[int, str]:
+        """Observations of the tasks, reduced.
+
+        Args:
+            question: The question of the query.
+            tasks: Tasks to get the observations of.
+            policies: Observation policy of each tool, by name.
+            seen: Sentences fed back so far in the query -> call of their first
+                task. Updated with the sentences kept for the tasks.
+
+        Returns:
+            idx of the task -> observation.
+        """
+        sentences = {
+            task.idx: split_sentences(task.get_observation_str())
+            for task in tasks.values()
+            if not task.is_join and task.observation is not None
+        }
+        # the sentences of all the observations of the plan are the corpus
+        terms = {idx: [_get_terms(s) for s in ss] for idx, ss in sentences.items()}
+        all_terms = [t for ts in terms.values() for t in ts]
+        document_frequencies = Counter(w for t in all_terms for w in set(t))
+        avg_length = sum(len(t) for t in all_terms) / max(len(all_terms), 1) or 1.0
+        question_terms = _get_terms(question)
+
+        observations = {}
+        for idx, task_sentences in sentences.items():
+            task = tasks[idx]
+            policy = policies.get(task.name) or self.default_policy
+            candidates = list(range(len(task_sentences)))
+            if self.dedup:
+                candidates = [
+                    i for i in candidates if _normalize(task_sentences[i]) not in seen
+                ]
+                if task_sentences and not candidates:
+                    reference = f"same as {seen[_normalize(task_sentences[0])]}"
+                    if len(reference) < len(task.get_observation_str()):
+                        observations[idx] = reference
+                        continue
+                    candidates = list(range(len(task_sentences)))
+
+            selected = candidates
+            if (
+                policy.max_sentences is not None
+                and len(candidates) > policy.max_sentences
+            ):
+                if self.select_relevant:
+                    selected = []
+                    if self.keep_first and candidates[0] == 0:
+                        selected, candidates = [0], candidates[1:]
+                    query_terms = question_terms + _get_terms(str(task.args))
+                    scores = self._score(
+                        query_terms,
+                        [terms[idx][i] for i in candidates],
+                        document_frequencies,
+                        len(all_terms),
+                        avg_length,
+                    )
+                    # the most relevant ones, earlier ones first on ties
+                    ranked = sorted(
+                        range(len(candidates)), key=lambda i: (-scores[i], i)
+                    )
+                    num_ranked = policy.max_sentences - len(selected)
+                    selected = sorted(
+                        selected + [candidates[i] for i in ranked[:num_ranked]]
+                    )
+                else:
+                    selected = candidates[: policy.max_sentences]
+
+            if len(selected) == len(task_sentences):
+                observation = task.get_observation_str()
+            else:
+                observation = " ".join(task_sentences[i] for i in selected)
+            if policy.max_chars is not None:
+                observation = observation[: policy.max_chars]
+            if self.dedup:
+                action = task.get_action_str()
+                for i in selected:
+                    seen.setdefault(_normalize(task_sentences[i]), action)
+            observations[idx] = observation
+        return observations
@@ -10,16 +10,21 @@ from src.tools.base import StructuredTool, Tool
 
 THOUGHT_PATTERN = r"Thought: ([^\n]*)"
 ACTION_PATTERN = r"\n*(\d+)\. (\w+)\((.*)\)(\s*#\w+\n)?"
+# the part of an action before its arguments, e.g. "1. search"
+ACTION_HEADER_PATTERN = r"\s*(\d+)\. (\w+)$"
 # $1 or ${1} -> 1
 ID_PATTERN = r"\$\{?(\d+)\}?"
+_ID_RE = re.compile(ID_PATTERN)
 
 END_OF_PLAN = "<END_OF_PLAN>"
 
 
+def _get_referenced_ids(args: str) -> set[int]:
+    return {int(match) for match in _ID_RE.findall(args)}
+
+
 def default_dependency_rule(idx, args: str):
-    matches = re.findall(ID_PATTERN, args)
-    numbers = [int(match) for match in matches]
-    return idx in numbers
+    return idx in _get_referenced_ids(args)
 
 
 class LLMCompilerPlanParser(AgentOutputParser, extra="allow"):
@@ -102,8 +107,10 @@ def _get_dependencies_from_graph(
         # depends on the previous step
         dependencies = list(range(1, idx))
     else:
-        # define dependencies based on the dependency rule in tool_definitions.py
-        dependencies = [i for i in range(1, idx) if default_dependency_rule(i, args)]
+        # define dependencies based on the ids referenced in the args,
+        # parsed in a single pass instead of once per preceding action
+        referenced_ids = _get_referenced_ids(args)
+        dependencies = [i for i in sorted(referenced_ids) if 1 <= i < idx]
 
     return dependencies
 
@@ -117,14 +124,44 @@ def instantiate_task(
 ) -> Task:
     dependencies = _get_dependencies_from_graph(idx, tool_name, args)
     args = _parse_llm_compiler_action_args(args)
+    return instantiate_parsed_task(
+        tools=tools,
+        idx=idx,
+        tool_name=tool_name,
+        args=args,
+        dependencies=dependencies,
+        thought=thought,
+    )
+
+
+def instantiate_parsed_task(
+    tools: Sequence[Union[Tool, StructuredTool]],
+    idx: int,
+    tool_name: str,
+    args: Sequence[Any],
+    dependencies: Sequence[int],
+    thought: str,
+) -> Task:
+    """Instantiate a task from already parsed args and dependencies,
+    e.g. from a cached plan."""
     if tool_name == "join":
         # join does not have a tool
         tool_func = lambda x: None
         stringify_rule = None
+        limiter = None
+        timeout = None
+        retry_policy = None
+        hedge = False
+        cacheable = False
     else:
         tool = _find_tool(tool_name, tools)
         tool_func = tool.func
         stringify_rule = tool.stringify_rule
+        limiter = tool.get_limiter()
+        timeout = tool.timeout
+        retry_policy = tool.retry_policy
+        hedge = tool.hedge
+        cacheable = tool.cacheable
     return Task(
         idx=idx,
         name=tool_name,
@@ -134,4 +171,9 @@ def instantiate_task(
         stringify_rule=stringify_rule,
         thought=thought,
         is_join=tool_name == "join",
+        limiter=limiter,
+        timeout=timeout,
+        retry_policy=retry_policy,
+        hedge=hedge,
+        cacheable=cacheable,
     )
@@ -0,0 +1,499 @@
+"""Caches of planner outputs for repeated and templated questions."""
+
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+from src.docstore.cache import SearchCache, normalize_entity
+from src.llm_compiler.output_parser import instantiate_parsed_task
+from src.llm_compiler.task_fetching_unit import Task
+from src.tools.base import StructuredTool, Tool
+
+
+def _serialize_tasks(tasks: Mapping[int, Task]) -> list[dict]:
+    return [
+        {
+            "idx": task.idx,
+            "name": task.name,
+            "args": list(task.planned_args),
+            "dependencies": list(task.dependencies),
+            "thought": task.thought,
+        }
+        for task in tasks.values()
+    ]
+
+
+def _instantiate_tasks(
+    task_entries: Sequence[dict], tools: Sequence[Union[Tool, StructuredTool]]
+) -> Dict[int, Task]:
+    tasks = {}
+    for task in task_entries:
+        tasks[task["idx"]] = instantiate_parsed_task(
+            tools=tools,
+            idx=task["idx"],
+            tool_name=task["name"],
+            args=tuple(task["args"]),
+            dependencies=task["dependencies"],
+            thought=task["thought"],
+        )
+    return tasks
+
+
+class PlanCache:
+    """Caches the parsed task graph of the first plan of a question, keyed by
+    the normalized question and the version of the planner prompt, so that a
+    repeated question skips the planner LLM.
+
+    Entries are kept in memory with TTL and LRU eviction, and optionally in a
+    SQLite file (see SearchCache) that survives restarts, which is read and
+    written in a thread so that the disk I/O does not block the event loop.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+        max_entries: int = 10_000,
+    ) -> None:
+        """
+        Args:
+            path: Path to the SQLite file of the disk tier. None means memory only.
+            ttl: Time-to-live of an entry in seconds. None means no expiration.
+            max_entries: Max number of entries to keep in each tier.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (entry, created_at), in LRU order
+        self._entries: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self.disk_cache = (
+            SearchCache(path, ttl=ttl, max_entries=max_entries) if path else None
+        )
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    @staticmethod
+    def make_key(question: str, prompt_version: str) -> str:
+        return f"{prompt_version}:{normalize_entity(question)}"
+
+    async def _get_entry(self, key: str) -> Optional[dict]:
+        if key in self._entries:
+            entry, created_at = self._entries[key]
+            if self.ttl is None or time.time() - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                return entry
+            del self._entries[key]
+        if self.disk_cache is not None:
+            value = await self.disk_cache.aget(key)
+            if value is not None:
+                entry = json.loads(value)
+                self._put_entry(key, entry)
+                return entry
+        return None
+
+    def _put_entry(self, key: str, entry: dict) -> None:
+        self._entries[key] = (entry, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(
+        self, key: str, tools: Sequence[Union[Tool, StructuredTool]]
+    ) -> Optional[tuple[Dict[int, Task], int]]:
+        """Returns freshly instantiated tasks of the cached plan and the tokens
+        of the planner call that produced it, if any."""
+        entry = await self._get_entry(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_tokens += entry["num_tokens"]
+        return _instantiate_tasks(entry["tasks"], tools), entry["num_tokens"]
+
+    async def put(
+        self, key: str, tasks: Mapping[int, Task], num_tokens: int = 0
+    ) -> None:
+        """
+        Args:
+            tasks: Tasks of the plan, which may have run already.
+            num_tokens: Tokens of the planner call, saved by every hit.
+        """
+        entry = {"tasks": _serialize_tasks(tasks), "num_tokens": num_tokens}
+        try:
+            value = json.dumps(entry)
+        except TypeError:
+            # e.g. args that are not JSON serializable
+            return
+        self._put_entry(key, json.loads(value))
+        if self.disk_cache is not None:
+            await self.disk_cache.aput(key, value)
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        num_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
+
+
+# placeholder of the i-th entity of a question in the args of a plan template
+_ENTITY_MARKER = "<<ENTITY_{}>>"
+_ENTITY_MARKER_RE = re.compile(r"<<ENTITY_(\d+)>>")
+_TOKEN_RE = re.compile(r"\S+")
+_WORD_RE = re.compile(r"\w+")
+_PUNCTUATION = "\"'`.,;:!?()[]{}"
+# lowercase words that can appear inside an entity, e.g. "The Silence of the Lambs"
+_CONNECTORS = {"a", "an", "and", "de", "for", "in", "of", "on", "the", "to", "&"}
+
+
+def _tokenize(text: str) -> List[Tuple[int, int, str]]:
+    """Words of the text as (start, end, word), without surrounding punctuation
+    and possessives, e.g. "Obama's?" -> "Obama"."""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        word = token.lstrip(_PUNCTUATION)
+        start = match.start() + len(token) - len(word)
+        word = word.rstrip(_PUNCTUATION)
+        if word.endswith("'s"):
+            word = word[:-2]
+        if word:
+            tokens.append((start, start + len(word), word))
+    return tokens
+
+
+def _is_entity_word(word: str) -> bool:
+    return word[0].isupper() or word[0].isdigit()
+
+
+def _get_entity_runs(text: str) -> List[List[Tuple[int, int, str]]]:
+    """Maximal runs of capitalized or numeric words, possibly joined by
+    connectors, e.g. "Were Scott Derrickson and Ed Wood ..." ->
+    ["Were Scott Derrickson and Ed Wood"]."""
+    runs = []
+    run = []
+    for token in _tokenize(text):
+        if _is_entity_word(token[2]) or (run and token[2] in _CONNECTORS):
+            run.append(token)
+            continue
+        runs.append(run)
+        run = []
+    runs.append(run)
+    # an entity does not end with a connector
+    for run in runs:
+        while run and not _is_entity_word(run[-1][2]):
+            run.pop()
+    return [run for run in runs if run]
+
+
+def _is_entity(text: str, max_words: int) -> bool:
+    tokens = _tokenize(text)
+    return (
+        0 < len(tokens) <= max_words
+        and _is_entity_word(tokens[0][2])
+        and _is_entity_word(tokens[-1][2])
+        and all(_is_entity_word(w) or w in _CONNECTORS for _, _, w in tokens)
+    )
+
+
+def _get_arg_strings(value: Any) -> List[str]:
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [s for v in value for s in _get_arg_strings(v)]
+    return []
+
+
+def _map_arg_strings(value: Any, func) -> Any:
+    if isinstance(value, str):
+        return func(value)
+    if isinstance(value, list):
+        return [_map_arg_strings(v, func) for v in value]
+    return value
+
+
+def _entity_re(entity: str) -> re.Pattern:
+    return re.compile(rf"(?<!\w){re.escape(entity)}(?!\w)", re.IGNORECASE)
+
+
+def _extract_entities(
+    question: str, arg_strings: Sequence[str]
+) -> List[Tuple[int, int]]:
+    """Spans of the question that are entities used by the plan, i.e. the
+    longest spans of the capitalized runs of the question that appear in the
+    args of the plan, e.g. "Scott Derrickson" in search("Scott Derrickson")."""
+    arg_strings = [s.lower() for s in arg_strings]
+    spans = []
+    for run in _get_entity_runs(question):
+        for length in range(len(run), 0, -1):
+            for i in range(len(run) - length + 1):
+                first, last = run[i], run[i + length - 1]
+                if not (_is_entity_word(first[2]) and _is_entity_word(last[2])):
+                    continue
+                start, end = first[0], last[1]
+                if any(start < e and s < end for s, e in spans):
+                    continue
+                pattern = _entity_re(question[start:end])
+                if any(pattern.search(s) for s in arg_strings):
+                    spans.append((start, end))
+    return sorted(spans)
+
+
+class PlanTemplateCache:
+    """Reuses plans across structurally similar questions, e.g.
+    "Find a movie similar to A, B, C, D" for different movies.
+
+    A plan is abstracted into a template by replacing the entities of its
+    question that appear in its args with placeholders. A new question matches
+    a template if it is the template question with other entities in place of
+    the placeholders, and the cached plan is then instantiated with the new
+    entities. Candidate templates are retrieved from an inverted index of the
+    words of the template questions.
+
+    Matches are only used when they are unambiguous: the new entities must look
+    like entities (capitalized or numeric words), and plans that use a part of
+    an entity that is not abstracted, e.g. "Obama" of "Barack Obama", are never
+    stored as templates. Otherwise the planner is called as usual.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        min_similarity: float = 1.0,
+        max_candidates: int = 8,
+        max_entity_words: int = 8,
+    ) -> None:
+        """
+        Args:
+            max_entries: Max number of templates to keep.
+            min_similarity: Min fraction of the words of a template question that
+                the new question must contain for the template to be matched.
+            max_candidates: Max number of candidate templates to match per question.
+            max_entity_words: Max number of words of an entity.
+        """
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.max_candidates = max_candidates
+        self.max_entity_words = max_entity_words
+        # key -> template, in LRU order
+        self._templates: OrderedDict[str, dict] = OrderedDict()
+        # word of a template question -> keys of the templates
+        self._index: Dict[str, set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def _make_template(
+        self, question: str, prompt_version: str, tasks: Mapping[int, Task]
+    ) -> Optional[Tuple[str, dict]]:
+        question = " ".join(question.split())
+        task_entries = _serialize_tasks(tasks)
+        arg_strings = [
+            s for task in task_entries for s in _get_arg_strings(task["args"])
+        ]
+        spans = _extract_entities(question, arg_strings)
+        if not spans:
+            return None
+
+        # the same entity may appear more than once
+        entities = []
+        slots = []
+        for start, end in spans:
+            entity = question[start:end].lower()
+            if entity not in entities:
+                entities.append(entity)
+            slots.append(entities.index(entity))
+
+        # longest first, so that an entity that contains another is not split
+        entity_res = sorted(
+            ((i, _entity_re(e)) for i, e in enumerate(entities)),
+            key=lambda x: -len(entities[x[0]]),
+        )
+
+        def abstract(text: str) -> str:
+            for i, pattern in entity_res:
+                text = pattern.sub(_ENTITY_MARKER.format(i), text)
+            return text
+
+        for task in task_entries:
+            task["args"] = _map_arg_strings(task["args"], abstract)
+            task["thought"] = abstract(task["thought"])
+
+        # once abstracted, the plan must not use any part of a capitalized run of
+        # the question, e.g. "Obama" of "Barack Obama", which would not change
+        # along with the entities
+        run_words = {
+            w.lower()
+            for run in _get_entity_runs(question)
+            for _, _, w in run
+            if w not in _CONNECTORS
+        }
+        template_words = {
+            w.lower()
+            for task in task_entries
+            for s in _get_arg_strings(task["args"])
+            for w in _WORD_RE.findall(_ENTITY_MARKER_RE.sub(" ", s))
+        }
+        if run_words & template_words:
+            return None
+
+        literals = []
+        pattern = []
+        last_end = 0
+        seen = set()
+        for (start, end), slot in zip(spans, slots):
+            literal = question[last_end:start]
+            literals.append(literal.lower())
+            pattern.append(re.escape(literal))
+            literals.append(_ENTITY_MARKER.format(slot))
+            pattern.append(f"(?P=e{slot})" if slot in seen else f"(?P<e{slot}>.+?)")
+            seen.add(slot)
+            last_end = end
+        literals.append(question[last_end:].lower())
+        pattern.append(re.escape(question[last_end:]))
+
+        template_question = "".join(literals)
+        words = set(_WORD_RE.findall(_ENTITY_MARKER_RE.sub(" ", template_question)))
+        if not words:
+            # e.g. a question that is a single entity
+            return None
+        key = f"{prompt_version}:{template_question}"
+        template = {
+            "pattern": re.compile("".join(pattern), re.IGNORECASE),
+            "num_entities": len(entities),
+            "words": words,
+            "tasks": task_entries,
+        }
+        return key, template
+
+    def _match(
+        self, question: str, prompt_version: str
+    ) -> Optional[Tuple[dict, List[str]]]:
+        question = " ".join(question.split())
+        counts: Dict[str, int] = {}
+        for word in set(_WORD_RE.findall(question.lower())):
+            for key in self._index.get(word, ()):
+                counts[key] = counts.get(key, 0) + 1
+
+        prefix = f"{prompt_version}:"
+        candidates = []
+        for key, count in counts.items():
+            if not key.startswith(prefix):
+                continue
+            similarity = count / len(self._templates[key]["words"])
+            if similarity >= self.min_similarity:
+                candidates.append((similarity, key))
+        candidates.sort(reverse=True)
+
+        for _, key in candidates[: self.max_candidates]:
+            template = self._templates[key]
+            match = template["pattern"].fullmatch(question)
+            if match is None:
+                continue
+            entities = [
+                match.group(f"e{i}").strip() for i in range(template["num_entities"])
+            ]
+            if len({e.lower() for e in entities}) < len(entities):
+                # ambiguous, e.g. the same entity in two different slots
+                continue
+            if not all(_is_entity(e, self.max_entity_words) for e in entities):
+                continue
+            self._templates.move_to_end(key)
+            return template, entities
+        return None
+
+    def get(
+        self,
+        question: str,
+        prompt_version: str,
+        tools: Sequence[Union[Tool, StructuredTool]],
+    ) -> Optional[tuple[Dict[int, Task], int]]:
+        """Returns tasks of a matching template instantiated with the entities of
+        the question, and the tokens of the planner call that produced the
+        template, if any."""
+        matched = self._match(question, prompt_version)
+        if matched is None:
+            self.misses += 1
+            return None
+        template, entities = matched
+
+        def instantiate(text: str) -> str:
+            return _ENTITY_MARKER_RE.sub(lambda m: entities[int(m.group(1))], text)
+
+        task_entries = [
+            {
+                **task,
+                "args": _map_arg_strings(task["args"], instantiate),
+                "thought": instantiate(task["thought"]),
+            }
+            for task in template["tasks"]
+        ]
+        self.hits += 1
+        self.saved_tokens += template["num_tokens"]
+        return _instantiate_tasks(task_entries, tools), template["num_tokens"]
+
+    def put(
+        self,
+        question: str,
+        prompt_version: str,
+        tasks: Mapping[int, Task],
+        num_tokens: int = 0,
+    ) -> None:
+        """
+        Args:
+            question: The question the plan was made for.
+            prompt_version: Version of the planner prompt that made the plan.
+            tasks: Tasks of the plan, which may have run already.
+            num_tokens: Tokens of the planner call, saved by every hit.
+        """
+        template = self._make_template(question, prompt_version, tasks)
+        if template is None:
+            return
+        key, template = template
+        try:
+            # copy of the args, which must be JSON serializable as in PlanCache
+            template["tasks"] = json.loads(json.dumps(template["tasks"]))
+        except TypeError:
+            return
+        template["num_tokens"] = num_tokens
+
+        self._remove(key)
+        self._templates[key] = template
+        for word in template["words"]:
+            self._index.setdefault(word, set()).add(key)
+        while len(self._templates) > self.max_entries:
+            self._remove(next(iter(self._templates)))
+
+    def _remove(self, key: str) -> None:
+        template = self._templates.pop(key, None)
+        if template is None:
+            return
+        for word in template["words"]:
+            keys = self._index[word]
+            keys.discard(key)
+            if not keys:
+                del self._index[word]
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        num_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "templates": len(self._templates),
+        }
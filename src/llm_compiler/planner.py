@@ -1,6 +1,7 @@
 """LLM Compiler Planner"""
 
 import asyncio
+import hashlib
 import re
 from typing import Any, Optional, Sequence, Union
 from uuid import UUID
@@ -9,16 +10,17 @@ from langchain.callbacks.base import AsyncCallbackHandler, Callbacks
 from langchain.chat_models.base import BaseChatModel
 from langchain.llms.base import BaseLLM
 from langchain.schema import LLMResult
-from langchain.schema.messages import HumanMessage, SystemMessage
 
 from src.executors.schema import Plan
 from src.llm_compiler.constants import END_OF_PLAN
 from src.llm_compiler.output_parser import (
+    ACTION_HEADER_PATTERN,
     ACTION_PATTERN,
     THOUGHT_PATTERN,
     LLMCompilerPlanParser,
     instantiate_task,
 )
+from src.llm_compiler.prompt_prefix import PromptPrefix
 from src.llm_compiler.task_fetching_unit import Task
 from src.tools.base import StructuredTool, Tool
 from src.utils.logger_utils import log
@@ -83,78 +85,192 @@ def generate_llm_compiler_prompt(
     return prefix
 
 
+_THOUGHT_RE = re.compile(THOUGHT_PATTERN)
+_ACTION_RE = re.compile(ACTION_PATTERN)
+_ACTION_HEADER_RE = re.compile(ACTION_HEADER_PATTERN)
+
+# a quote only opens a string literal right after one of these characters,
+# so that e.g. the apostrophe in `search(Ronaldo's kids)` is not a string
+_STRING_START_PRECEDERS = "([{,=:"
+
+
 class StreamingGraphParser:
-    """Streaming version of the GraphParser."""
+    """Streaming version of the GraphParser.
 
-    buffer = ""
-    thought = ""
-    graph_dict = {}
+    The stream is parsed incrementally by a small state machine that looks at each
+    character once, so every token costs O(len(token)).
+    An action `<idx>. <tool_name>(<args>)` is emitted as soon as its closing
+    parenthesis balances (taking nested brackets and string literals into account),
+    without waiting for the end of the line.
+
+    All the parsing state lives on the instance, so a parser must not be shared
+    by concurrent streams. Call `reset` to reuse it for a new stream.
+    """
 
     def __init__(self, tools: Sequence[Union[Tool, StructuredTool]]) -> None:
         self.tools = tools
-
-    def _match_buffer_and_generate_task(self, suffix: str) -> Optional[Task]:
-        """Runs every time "\n" is encountered in the input stream or at the end of the stream.
-        Matches the buffer against the regex patterns and generates a task if a match is found.
-        Match patterns include:
+        self.reset()
+
+    def reset(self) -> None:
+        """Reset the parser to parse a new stream."""
+        self.thought = ""
+        self._reset_line()
+
+    def _reset_line(self) -> None:
+        self._line: list[str] = []
+        # index in self._line where the arguments start, if inside an action
+        self._args_start: Optional[int] = None
+        self._depth = 0
+        self._quote: Optional[str] = None
+        self._escaped = False
+        self._prev_char = ""
+        # whether the action of the current line has already been emitted
+        self._line_done = False
+
+    def _generate_task(self, idx: str, tool_name: str, args: str) -> Task:
+        task = instantiate_task(
+            tools=self.tools,
+            idx=int(idx),
+            tool_name=tool_name,
+            args=args,
+            thought=self.thought,
+        )
+        self.thought = ""
+        return task
+
+    def _complete_action(self) -> Task:
+        """Runs when the parenthesis of the arguments balances."""
+        self._line_done = True
+        header = "".join(self._line[: self._args_start - 1])
+        idx, tool_name = _ACTION_HEADER_RE.match(header).groups()
+        args = "".join(self._line[self._args_start : -1])
+        return self._generate_task(idx, tool_name, args)
+
+    def _complete_line(self) -> Optional[Task]:
+        """Runs every time "\n" is encountered in the input stream or at the end of
+        the stream. Match patterns include:
         1. Thought: <thought>
-          - this case, the thought is stored in self.thought, and we reset the buffer.
+          - this case, the thought is stored in self.thought.
           - the thought is then used as the thought for the next action.
-        2. <idx>. <tool_name>(<args>)
-          - this case, the tool is instantiated with the idx, tool_name, args, and thought.
-          - the thought is reset.
-          - the buffer is reset.
+        2. <idx>. <tool_name>(<args>) whose parenthesis never balanced
+          (e.g. due to unmatched quotes in the args)
+          - this case, fall back to the greedy ACTION_PATTERN.
         """
-        if match := re.match(THOUGHT_PATTERN, self.buffer):
-            # Optionally, action can be preceded by a thought
-            self.thought = match.group(1)
-        elif match := re.match(ACTION_PATTERN, self.buffer):
-            # if action is parsed, return the task, and clear the buffer
-            idx, tool_name, args, _ = match.groups()
-            idx = int(idx)
-            task = instantiate_task(
-                tools=self.tools,
-                idx=idx,
-                tool_name=tool_name,
-                args=args,
-                thought=self.thought,
-            )
-            self.thought = ""
-            return task
-
+        task = None
+        if not self._line_done:
+            line = "".join(self._line).strip()
+            if self._args_start is not None:
+                if match := _ACTION_RE.match(line):
+                    idx, tool_name, args, _ = match.groups()
+                    task = self._generate_task(idx, tool_name, args)
+            elif match := _THOUGHT_RE.match(line):
+                # Optionally, action can be preceded by a thought
+                self.thought = match.group(1)
+        self._reset_line()
+        return task
+
+    def _ingest_char(self, char: str) -> Optional[Task]:
+        if char == "\n":
+            return self._complete_line()
+        if self._line_done:
+            # skip the rest of the line after an action, e.g. comments
+            return None
+        self._line.append(char)
+
+        if self._args_start is None:
+            if char == "(" and _ACTION_HEADER_RE.match("".join(self._line[:-1])):
+                self._args_start = len(self._line)
+                self._depth = 1
+                self._prev_char = char
+            return None
+
+        # inside the arguments of an action
+        if self._quote:
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == self._quote:
+                self._quote = None
+        elif char in "\"'" and self._prev_char in _STRING_START_PRECEDERS:
+            self._quote = char
+        elif char in "([{":
+            self._depth += 1
+        elif char in ")]}":
+            self._depth -= 1
+            if self._depth == 0:
+                return self._complete_action()
+        if not char.isspace():
+            self._prev_char = char
         return None
 
-    def ingest_token(self, token: str) -> Optional[Task]:
-        # Append token to buffer
-        if "\n" in token:
-            prefix, suffix = token.split("\n", 1)
-            prefix = prefix.strip()
-            self.buffer += prefix + "\n"
-            matched_item = self._match_buffer_and_generate_task(suffix)
-            self.buffer = suffix
-            return matched_item
-        else:
-            self.buffer += token
+    def ingest_token(self, token: str) -> list[Task]:
+        """Ingest a streamed token, and return the tasks completed by it."""
+        tasks = []
+        for char in token:
+            if task := self._ingest_char(char):
+                tasks.append(task)
+        return tasks
 
-        return None
+    def finalize(self) -> list[Task]:
+        task = self._complete_line()
+        return [task] if task else []
 
-    def finalize(self):
-        self.buffer = self.buffer + "\n"
-        return self._match_buffer_and_generate_task("")
+
+class StreamingGraphParserPool:
+    """Pool of reusable StreamingGraphParsers for a set of tools, so that serving
+    many concurrent plan streams does not allocate a new parser per stream."""
+
+    def __init__(
+        self, tools: Sequence[Union[Tool, StructuredTool]], max_size: int = 64
+    ) -> None:
+        """
+        Args:
+            max_size: Max number of idle parsers to keep around.
+        """
+        self.tools = tools
+        self.max_size = max_size
+        self._idle_parsers: list[StreamingGraphParser] = []
+
+    def acquire(self) -> StreamingGraphParser:
+        if self._idle_parsers:
+            return self._idle_parsers.pop()
+        return StreamingGraphParser(tools=self.tools)
+
+    def release(self, parser: StreamingGraphParser) -> None:
+        parser.reset()
+        if len(self._idle_parsers) < self.max_size:
+            self._idle_parsers.append(parser)
 
 
 class LLMCompilerCallback(AsyncCallbackHandler):
+    """Parses the streamed plan, and puts the tasks into the queue as they arrive.
+    Each LLM run (keyed by its run_id) gets its own parser, so the callback never
+    mixes the tokens of different streams."""
+
     _queue: asyncio.Queue[Optional[Task]]
-    _parser: StreamingGraphParser
-    _tools: Sequence[Union[Tool, StructuredTool]]
+    _parser_pool: StreamingGraphParserPool
+    _parsers: dict[UUID, StreamingGraphParser]
 
     def __init__(
         self,
         queue: asyncio.Queue[Optional[str]],
         tools: Sequence[Union[Tool, StructuredTool]],
+        parser_pool: Optional[StreamingGraphParserPool] = None,
     ):
         self._queue = queue
-        self._parser = StreamingGraphParser(tools=tools)
+        self._parser_pool = parser_pool or StreamingGraphParserPool(tools=tools)
+        self._parsers = {}
+
+    def _get_parser(self, run_id: UUID) -> StreamingGraphParser:
+        if run_id not in self._parsers:
+            self._parsers[run_id] = self._parser_pool.acquire()
+        return self._parsers[run_id]
+
+    def _release_parser(self, run_id: UUID) -> None:
+        parser = self._parsers.pop(run_id, None)
+        if parser:
+            self._parser_pool.release(parser)
 
     async def on_llm_start(self, serialized, prompts, **kwargs: Any) -> Any:
         """Run when LLM starts running."""
@@ -167,10 +283,9 @@ class LLMCompilerCallback(AsyncCallbackHandler):
         parent_run_id: Optional[UUID] = None,
         **kwargs: Any,
     ) -> None:
-        parsed_data = self._parser.ingest_token(token)
-        if parsed_data:
-            await self._queue.put(parsed_data)
-            if parsed_data.is_join:
+        for task in self._get_parser(run_id).ingest_token(token):
+            await self._queue.put(task)
+            if task.is_join:
                 await self._queue.put(None)
 
     async def on_llm_end(
@@ -181,9 +296,22 @@ class LLMCompilerCallback(AsyncCallbackHandler):
         parent_run_id: Optional[UUID] = None,
         **kwargs: Any,
     ) -> None:
-        parsed_data = self._parser.finalize()
-        if parsed_data:
-            await self._queue.put(parsed_data)
+        for task in self._get_parser(run_id).finalize():
+            await self._queue.put(task)
+        self._release_parser(run_id)
+        await self._queue.put(None)
+
+    async def on_llm_error(
+        self,
+        error: BaseException,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        self._release_parser(run_id)
+        # signal the end of the stream, so that the task fetching unit does not
+        # wait forever for the remaining tasks
         await self._queue.put(None)
 
 
@@ -209,10 +337,24 @@ class Planner:
             example_prompt=example_prompt_replan,
             is_replan=True,
         )
+        # identifies the prompts, e.g. to invalidate the cached plans
+        self.prompt_version = hashlib.sha1(
+            (self.system_prompt + self.system_prompt_replan).encode()
+        ).hexdigest()[:16]
+        # the system prompts are the static prefixes of every planner request
+        self.prompt_prefix = PromptPrefix(self.system_prompt, separator="\n\n")
+        self.prompt_prefix_replan = PromptPrefix(
+            self.system_prompt_replan, separator="\n\n"
+        )
         self.tools = tools
         self.output_parser = LLMCompilerPlanParser(tools=tools)
+        # shared by the concurrent streaming plans of this planner
+        self.parser_pool = StreamingGraphParserPool(tools=tools)
         self.stop = stop
 
+    def get_prompt_prefix(self, is_replan: bool) -> PromptPrefix:
+        return self.prompt_prefix_replan if is_replan else self.prompt_prefix
+
     async def run_llm(
         self,
         inputs: dict[str, Any],
@@ -220,19 +362,15 @@ class Planner:
         callbacks: Callbacks = None,
     ) -> str:
         """Run the LLM."""
+        prompt_prefix = self.get_prompt_prefix(is_replan)
         if is_replan:
-            system_prompt = self.system_prompt_replan
             assert "context" in inputs, "If replanning, context must be provided"
             human_prompt = f"Question: {inputs['input']}\n{inputs['context']}\n"
         else:
-            system_prompt = self.system_prompt
             human_prompt = f"Question: {inputs['input']}"
 
         if isinstance(self.llm, BaseChatModel):
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=human_prompt),
-            ]
+            messages = prompt_prefix.format_messages(human_prompt)
             llm_response = await self.llm._call_async(
                 messages,
                 callbacks=callbacks,
@@ -240,7 +378,7 @@ class Planner:
             )
             response = llm_response.content
         elif isinstance(self.llm, BaseLLM):
-            message = system_prompt + "\n\n" + human_prompt
+            message = prompt_prefix.format(human_prompt)
             response = await self.llm.apredict(
                 message,
                 callbacks=callbacks,
@@ -275,6 +413,7 @@ class Planner:
             LLMCompilerCallback(
                 queue=task_queue,
                 tools=self.tools,
+                parser_pool=self.parser_pool,
             )
         ]
         if callbacks:
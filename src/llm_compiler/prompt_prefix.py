@@ -0,0 +1,48 @@
+"""Static prompt prefixes shared by every request."""
+
+from typing import Optional
+
+import tiktoken
+from langchain.schema.messages import HumanMessage, SystemMessage
+
+
+class PromptPrefix:
+    """The static part of a prompt (instructions and examples), built once.
+
+    The prefix always comes first and is byte-identical across requests, with
+    only the per-request content appended after it, so that the prefill of the
+    prefix can be served from the server-side prefix (KV) cache of vLLM or
+    OpenAI.
+    """
+
+    def __init__(self, text: str, separator: str = "") -> None:
+        """
+        Args:
+            text: The static prefix.
+            separator: Appended to the prefix before the per-request content
+                of a completion prompt. Kept as part of the prefix so that it is
+                cached as well.
+        """
+        self.text = text
+        self.completion_prefix = text + separator
+        # built once, so that chat requests share the very same system message
+        self.system_message = SystemMessage(content=text)
+        self._num_tokens: Optional[int] = None
+
+    @property
+    def num_tokens(self) -> int:
+        """Number of tokens of the prefix, i.e. the prefix-cache-eligible tokens
+        of every request."""
+        if self._num_tokens is None:
+            # same for gpt-3.5
+            encoder = tiktoken.encoding_for_model("gpt-4")
+            self._num_tokens = len(encoder.encode(self.completion_prefix))
+        return self._num_tokens
+
+    def format(self, suffix: str) -> str:
+        """Completion prompt with the per-request suffix."""
+        return self.completion_prefix + suffix
+
+    def format_messages(self, suffix: str) -> list:
+        """Chat messages with the per-request suffix as the user message."""
+        return [self.system_message, HumanMessage(content=suffix)]
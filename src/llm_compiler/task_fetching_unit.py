@@ -1,13 +1,32 @@
 from __future__ import annotations
 
 import asyncio
-from dataclasses import dataclass
-from typing import Any, Callable, Collection, Dict, List, Optional
+import inspect
+import math
+import re
+import time
+from collections import ChainMap, defaultdict, deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
+from src.callbacks.callbacks import ToolStatsCollector
+from src.llm_compiler.tool_cache import ToolResultCache
+from src.tools.base import RetryPolicy, ToolLimiter
 from src.utils.logger_utils import log
 
-SCHEDULING_INTERVAL = 0.01  # seconds
-
 
 def _default_stringify_rule_for_arguments(args):
     if len(args) == 1:
@@ -16,28 +35,132 @@ def _default_stringify_rule_for_arguments(args):
         return str(tuple(args))
 
 
-def _replace_arg_mask_with_real_value(
-    args, dependencies: List[int], tasks: Dict[str, Task]
-):
-    if isinstance(args, (list, tuple)):
-        return type(args)(
-            _replace_arg_mask_with_real_value(item, dependencies, tasks)
-            for item in args
+# ${1} or $1 -> 1
+_ARG_MASK_RE = re.compile(r"\$\{(\d+)\}|\$(\d+)")
+
+
+class _ArgTemplate:
+    """A string argument pre-split at plan time into literal segments and
+    references to dependencies, e.g. "age of $1" -> ["age of ", (1, "$1")],
+    so that substituting the observations is a single join at execution time."""
+
+    def __init__(self, segments: List[Union[str, Tuple[int, str]]]):
+        self.segments = segments
+        # whether the argument is exactly a single reference, e.g. "$1"
+        self.is_reference = (
+            len(segments) == 3 and segments[0] == "" and segments[2] == ""
         )
+
+    def render(self, tasks: Mapping[int, Task], typed: bool = False) -> Any:
+        """If `typed`, an argument that is exactly a reference receives the raw
+        observation object instead of its string."""
+        if typed and self.is_reference:
+            dependency, arg_mask = self.segments[1]
+            task = tasks.get(dependency)
+            observation = None if task is None else task.observation
+            return arg_mask if observation is None else observation
+
+        rendered = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                rendered.append(segment)
+                continue
+            dependency, arg_mask = segment
+            task = tasks.get(dependency)
+            observation = None if task is None else task.get_observation_str()
+            # keep the mask if the dependency does not exist or has no observation
+            rendered.append(arg_mask if observation is None else observation)
+        return "".join(rendered)
+
+
+def _compile_arg_template(args, dependencies: Collection[int]):
+    """Replace string arguments that reference dependencies with _ArgTemplates.
+    Only exact references to dependencies are replaced, so "$1" never matches
+    the prefix of "$10"."""
+    if isinstance(args, (list, tuple)):
+        return type(args)(_compile_arg_template(item, dependencies) for item in args)
     elif isinstance(args, str):
-        for dependency in sorted(dependencies, reverse=True):
-            # consider both ${1} and $1 (in case planner makes a mistake)
-            for arg_mask in ["${" + str(dependency) + "}", "$" + str(dependency)]:
-                if arg_mask in args:
-                    if tasks[dependency].observation is not None:
-                        args = args.replace(
-                            arg_mask, str(tasks[dependency].observation)
-                        )
+        segments = []
+        start = 0
+        for match in _ARG_MASK_RE.finditer(args):
+            dependency = int(match.group(1) or match.group(2))
+            if dependency not in dependencies:
+                continue
+            segments.append(args[start : match.start()])
+            segments.append((dependency, match.group(0)))
+            start = match.end()
+        if not segments:
+            return args
+        segments.append(args[start:])
+        return _ArgTemplate(segments)
+    else:
         return args
+
+
+def _render_arg_template(args, tasks: Mapping[int, Task], typed: bool = False):
+    """Replace dependency placeholders, i.e. ${1}, with the actual observations."""
+    if isinstance(args, (list, tuple)):
+        return type(args)(_render_arg_template(item, tasks, typed) for item in args)
+    elif isinstance(args, _ArgTemplate):
+        return args.render(tasks, typed)
     else:
         return args
 
 
+def _is_async_callable(func: Callable) -> bool:
+    return inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(
+        getattr(func, "__call__", None)
+    )
+
+
+class ToolLatencyTracker:
+    """Tracks the latency of each tool across queries, as an exponential moving
+    average, to estimate how long a task will take before it runs, and as a
+    window of the recent latencies, to estimate their percentiles.
+
+    The latency of a call that did not finish, e.g. timed out or cancelled, is
+    how long it ran for, which is a lower bound of its actual latency."""
+
+    def __init__(
+        self,
+        smoothing: float = 0.2,
+        default_latency: float = 1.0,
+        window_size: int = 200,
+        min_samples: int = 20,
+    ):
+        self.smoothing = smoothing
+        # used for tools that have never run
+        self.default_latency = default_latency
+        # percentiles are only estimated from at least `min_samples` latencies
+        self.min_samples = min_samples
+        self.latencies: Dict[str, float] = {}
+        self.recent_latencies: Dict[str, deque] = defaultdict(
+            lambda: deque(maxlen=window_size)
+        )
+
+    def observe(self, tool_name: str, latency: float) -> None:
+        if tool_name not in self.latencies:
+            self.latencies[tool_name] = latency
+        else:
+            self.latencies[tool_name] += self.smoothing * (
+                latency - self.latencies[tool_name]
+            )
+        self.recent_latencies[tool_name].append(latency)
+
+    def get_latency(self, tool_name: str) -> float:
+        return self.latencies.get(tool_name, self.default_latency)
+
+    def get_percentile(self, tool_name: str, percentile: float) -> Optional[float]:
+        """The given percentile (0-100) of the recent latencies of the tool, or
+        None if the tool has not run enough times yet."""
+        recent_latencies = self.recent_latencies.get(tool_name)
+        if not recent_latencies or len(recent_latencies) < self.min_samples:
+            return None
+        recent_latencies = sorted(recent_latencies)
+        rank = math.ceil(percentile / 100 * len(recent_latencies)) - 1
+        return recent_latencies[max(rank, 0)]
+
+
 @dataclass
 class Task:
     idx: int
@@ -47,119 +170,534 @@ class Task:
     dependencies: Collection[int]
     stringify_rule: Optional[Callable] = None
     thought: Optional[str] = None
-    observation: Optional[str] = None
+    observation: Optional[Any] = None
     is_join: bool = False
+    # max seconds the tool can take to run the task
+    timeout: Optional[float] = None
+    # enforces the concurrency and rate limits of the tool, if any
+    limiter: Optional[ToolLimiter] = field(default=None, repr=False)
+    retry_policy: Optional[RetryPolicy] = field(default=None, repr=False)
+    # whether to issue a duplicate call if the tool is slower than usual
+    hedge: bool = False
+    # whether the result can be served from the tool result cache
+    cacheable: bool = True
+    # args with the dependency placeholders pre-compiled, see _compile_arg_template
+    arg_templates: Any = field(default=None, repr=False)
+    # args as planned, i.e. with the dependency placeholders, since `args` is
+    # replaced by the actual values when the task runs
+    planned_args: Any = field(default=None, repr=False)
+    # (observation, str(observation)), so that an observation referenced by
+    # several tasks and the joinner is stringified only once
+    _observation_str: Optional[Tuple[Any, str]] = field(
+        default=None, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        if self.planned_args is None:
+            self.planned_args = self.args
+        if self.arg_templates is None:
+            dependencies = set(self.dependencies)
+            self.arg_templates = [
+                _compile_arg_template(arg, dependencies) for arg in self.args
+            ]
+
+    def get_observation_str(self) -> Optional[str]:
+        if self.observation is None:
+            return None
+        if self._observation_str is None or self._observation_str[0] is not (
+            self.observation
+        ):
+            self._observation_str = (self.observation, str(self.observation))
+        return self._observation_str[1]
 
     async def __call__(self) -> Any:
         log("running task")
-        x = await self.tool(*self.args)
+        if _is_async_callable(self.tool):
+            x = await self.tool(*self.args)
+        else:
+            # sync tools would block the event loop (and every other parallel task),
+            # so dispatch them to the default executor
+            x = await asyncio.get_running_loop().run_in_executor(
+                None, partial(self.tool, *self.args)
+            )
+            if inspect.isawaitable(x):
+                x = await x
         log("done task")
         return x
 
+    def get_action_str(self) -> str:
+        """The call of the task, as rendered in the prompts, e.g. search(Ed Wood)."""
+        if self.stringify_rule:
+            # If the user has specified a custom stringify rule for the
+            # function argument, use it
+            return self.stringify_rule(self.args)
+        # Otherwise, we have a default stringify rule
+        return f"{self.name}{_default_stringify_rule_for_arguments(self.args)}"
+
     def get_though_action_observation(
-        self, include_action=True, include_thought=True, include_action_idx=False
+        self,
+        include_action=True,
+        include_thought=True,
+        include_action_idx=False,
+        observation: Optional[str] = None,
     ) -> str:
+        """
+        Args:
+            observation: Replaces the observation string, e.g. when truncated.
+        """
         thought_action_observation = ""
         if self.thought and include_thought:
             thought_action_observation = f"Thought: {self.thought}\n"
         if include_action:
             idx = f"{self.idx}. " if include_action_idx else ""
-            if self.stringify_rule:
-                # If the user has specified a custom stringify rule for the
-                # function argument, use it
-                thought_action_observation += f"{idx}{self.stringify_rule(self.args)}\n"
-            else:
-                # Otherwise, we have a default stringify rule
-                thought_action_observation += (
-                    f"{idx}{self.name}"
-                    f"{_default_stringify_rule_for_arguments(self.args)}\n"
-                )
+            thought_action_observation += f"{idx}{self.get_action_str()}\n"
         if self.observation is not None:
-            thought_action_observation += f"Observation: {self.observation}\n"
+            if observation is None:
+                observation = self.get_observation_str()
+            thought_action_observation += f"Observation: {observation}\n"
         return thought_action_observation
 
 
 class TaskFetchingUnit:
+    """Schedules tasks as soon as all of their dependencies are done.
+
+    Instead of periodically polling for executable tasks, each task keeps a count
+    of its unfinished dependencies. When a task finishes, the counts of its
+    dependents are decremented and the ones that reach zero are launched immediately.
+    """
+
     tasks: Dict[str, Task]
     tasks_done: Dict[str, asyncio.Event]
     remaining_tasks: set[str]
 
-    def __init__(self):
+    def __init__(
+        self,
+        typed_observations: bool = False,
+        tool_stats: Optional[ToolStatsCollector] = None,
+        latency_tracker: Optional[ToolLatencyTracker] = None,
+        task_timeout: Optional[float] = None,
+        plan_timeout: Optional[float] = None,
+        tool_cache: Optional[ToolResultCache] = None,
+        previous_tasks: Optional[Sequence[Task]] = None,
+    ):
+        """
+        Args:
+            typed_observations: Whether to pass the raw observation object to an
+                argument that is exactly a reference, e.g. "$1", instead of its
+                string. References inside larger strings are always stringified.
+            tool_stats: Collects the queue wait time and run time of the tasks.
+            latency_tracker: Tracks the latency of the tools across queries, which
+                is used to prioritize the tasks on the critical path when they
+                wait for the limits of their tools.
+            task_timeout: Default max seconds a task can take to run, for the
+                tools that do not declare their own timeout. A task that fails
+                or times out gets an error observation, and the tasks depending
+                on it are skipped.
+            plan_timeout: Max seconds to run all the tasks. When it expires, the
+                tasks that are not done are cancelled and get an error observation.
+            tool_cache: Memoizes the results of the tools across plans and queries.
+            previous_tasks: Successfully completed tasks of the previous plans of
+                the query. A task that calls the same tool with the same arguments
+                reuses their observation instead of running again, and a
+                reference to an index that is not in the current plan, e.g. "$2",
+                resolves to the previous task with that index.
+        """
+        self.typed_observations = typed_observations
+        self.tool_stats = tool_stats
+        self.latency_tracker = latency_tracker or ToolLatencyTracker()
+        self.task_timeout = task_timeout
+        self.plan_timeout = plan_timeout
+        self.tool_cache = tool_cache
+        previous_tasks = previous_tasks or []
+        # index -> latest previous task with that index
+        self.previous_tasks: Dict[int, Task] = {
+            task.idx: task for task in previous_tasks
+        }
+        # (tool name, args) -> observation of the previous tasks
+        self.previous_observations: Dict[Any, Any] = {
+            ToolResultCache.make_key(task.name, task.args): task.observation
+            for task in previous_tasks
+        }
         self.tasks = {}
+        # tasks that the args can reference, the current ones first
+        self.referenceable_tasks = ChainMap(self.tasks, self.previous_tasks)
         self.tasks_done = {}
+        # number of the tasks_done events that are set
+        self.num_tasks_done = 0
         self.remaining_tasks = set()
+        # task idx -> number of dependencies that are not done yet
+        self.num_pending_dependencies: Dict[int, int] = {}
+        # task idx -> tasks that depend on it
+        self.dependents: Dict[int, List[int]] = defaultdict(list)
+        # task idx -> all tasks that depend on it, including finished ones
+        self.children: Dict[int, List[int]] = defaultdict(list)
+        # task idx -> expected time from its start until the end of the longest
+        # chain of tasks depending on it, updated as tasks arrive
+        self.critical_path_lengths: Dict[int, float] = {}
+        # set when no more tasks are expected and all received tasks are done
+        self.all_done = asyncio.Event()
+        self.no_more_tasks = False
+        # tasks that failed, timed out or were skipped
+        self.failed_tasks: set[int] = set()
+        # indices that tasks depend on but that never arrived
+        self.unknown_tasks: set[int] = set()
+        # whether the plan timeout expired
+        self.timed_out = False
+        # keep references to the running asyncio tasks so they are not GC'ed
+        self._running_tasks: set[asyncio.Task] = set()
 
     def set_tasks(self, tasks: dict[str, Any]):
+        for task in tasks.values():
+            if task.timeout is None:
+                task.timeout = self.task_timeout
         self.tasks.update(tasks)
         self.tasks_done.update({task_idx: asyncio.Event() for task_idx in tasks})
         self.remaining_tasks.update(set(tasks.keys()))
+        for task_idx, task in tasks.items():
+            num_pending = 0
+            for dependency in task.dependencies:
+                self.children[dependency].append(task_idx)
+                if self._is_done(dependency) or (
+                    dependency not in self.tasks and dependency in self.previous_tasks
+                ):
+                    continue
+                self.dependents[dependency].append(task_idx)
+                num_pending += 1
+            self.num_pending_dependencies[task_idx] = num_pending
+        for task_idx in sorted(tasks):
+            self._update_critical_path_lengths(task_idx)
+
+    def _is_done(self, task_idx: int) -> bool:
+        return task_idx in self.tasks_done and self.tasks_done[task_idx].is_set()
 
     def _all_tasks_done(self):
-        return all(self.tasks_done[d].is_set() for d in self.tasks_done)
+        return self.num_tasks_done == len(self.tasks_done)
+
+    def _get_latency(self, task_idx: int) -> float:
+        task = self.tasks[task_idx]
+        return 0 if task.is_join else self.latency_tracker.get_latency(task.name)
+
+    def _update_critical_path_lengths(self, task_idx: int):
+        """Set the critical path length of a new task, based on the latency of the
+        tools, and extend those of the tasks it depends on, which are the only
+        ones that can change."""
+        length = self._get_latency(task_idx) + max(
+            (
+                self.critical_path_lengths[child]
+                for child in self.children[task_idx]
+                if child in self.critical_path_lengths
+            ),
+            default=0,
+        )
+        stack = [(task_idx, length)]
+        while stack:
+            task_idx, length = stack.pop()
+            if length <= self.critical_path_lengths.get(task_idx, -1):
+                continue
+            self.critical_path_lengths[task_idx] = length
+            for dependency in self.tasks[task_idx].dependencies:
+                if dependency in self.tasks:
+                    stack.append((dependency, self._get_latency(dependency) + length))
 
     def _get_all_executable_tasks(self):
         return [
             task_name
             for task_name in self.remaining_tasks
-            if all(
-                self.tasks_done[d].is_set() for d in self.tasks[task_name].dependencies
-            )
+            if self.num_pending_dependencies[task_name] == 0
         ]
 
+    def _drop_unknown_dependencies(self):
+        """Once no more tasks are expected, dependencies on tasks that never arrived
+        (e.g. the planner skipped an index) can never be satisfied, so drop them.
+        The tasks depending on them fail instead of waiting forever."""
+        for dependency in list(self.dependents):
+            if dependency in self.tasks:
+                continue
+            log(f"Dropping dependency on unknown task {dependency}")
+            self.unknown_tasks.add(dependency)
+            for task_idx in self.dependents.pop(dependency):
+                self.num_pending_dependencies[task_idx] -= 1
+
+    def _launch_executable_tasks(self):
+        self._launch_tasks(self._get_all_executable_tasks())
+
+    def _launch_tasks(self, task_idxs: List[int]):
+        # launch the tasks that unblock the longest chains first, and let them
+        # through the limits of their tools first
+        task_idxs = sorted(
+            (idx for idx in task_idxs if idx in self.remaining_tasks),
+            key=lambda idx: -self.critical_path_lengths[idx],
+        )
+        for task_name in task_idxs:
+            self.remaining_tasks.remove(task_name)
+            running_task = asyncio.create_task(
+                self._run_task(
+                    self.tasks[task_name],
+                    priority=self.critical_path_lengths[task_name],
+                )
+            )
+            self._running_tasks.add(running_task)
+            running_task.add_done_callback(self._running_tasks.discard)
+
+    def _check_all_done(self):
+        if self.no_more_tasks and self._all_tasks_done():
+            self.all_done.set()
+
     def _preprocess_args(self, task: Task):
         """Replace dependency placeholders, i.e. ${1}, in task.args with the actual observation."""
-        args = []
-        for arg in task.args:
-            arg = _replace_arg_mask_with_real_value(arg, task.dependencies, self.tasks)
-            args.append(arg)
-        task.args = args
-
-    async def _run_task(self, task: Task):
-        self._preprocess_args(task)
-        if not task.is_join:
-            observation = await task()
-            task.observation = observation
+        task.args = [
+            _render_arg_template(arg, self.referenceable_tasks, self.typed_observations)
+            for arg in task.arg_templates
+        ]
+
+    async def _run_task(self, task: Task, priority: float = 0):
+        # any failure, e.g. of rendering the args, becomes the observation of the
+        # task, so that it is still marked done and its dependents are unblocked
+        try:
+            await self._execute_task(task, priority)
+        except asyncio.TimeoutError:
+            self._fail_task(task, f"{task.name} timed out after {task.timeout}s")
+        except Exception as e:
+            self._fail_task(task, f"{type(e).__name__}: {e}")
+        self._mark_done(task)
+
+    async def _execute_task(self, task: Task, priority: float = 0):
+        if task.is_join:
+            self._preprocess_args(task)
+            return
+        unknown_dependencies = [
+            dependency
+            for dependency in task.dependencies
+            if dependency in self.unknown_tasks
+        ]
+        failed_dependencies = [
+            dependency
+            for dependency in task.dependencies
+            if dependency in self.failed_tasks
+        ]
+        # the arguments of the task are not available, so don't run it
+        if unknown_dependencies:
+            self._fail_task(task, f"action {unknown_dependencies[0]} does not exist")
+        elif failed_dependencies:
+            self._fail_task(
+                task, f"Skipped since action {failed_dependencies[0]} failed"
+            )
+        else:
+            self._preprocess_args(task)
+            task.observation = await self._run_task_with_cache(task, priority)
+
+    async def _run_task_with_cache(self, task: Task, priority: float = 0) -> Any:
+        """Serve the task from the previous plans or the tool result cache, or run
+        it and cache its result. Identical tasks in flight share a single tool
+        call."""
+        key = ToolResultCache.make_key(task.name, task.args)
+        if key in self.previous_observations:
+            log(f"Task {task.idx} was already done in a previous plan")
+            if self.tool_stats is not None:
+                self.tool_stats.on_tool_reuse(task.name)
+            return self.previous_observations[key]
+        if self.tool_cache is None or not task.cacheable:
+            return await self._run_task_with_limits(task, priority)
+        observation, is_hit = await self.tool_cache.get_or_call(
+            key,
+            partial(self._run_task_with_limits, task, priority),
+        )
+        if is_hit and self.tool_stats is not None:
+            self.tool_stats.on_tool_cache_hit(task.name)
+        return observation
+
+    async def _run_task_with_limits(self, task: Task, priority: float = 0) -> Any:
+        """Run the task, retrying transient failures with exponential backoff if
+        the tool has a retry policy. Every attempt waits until the tool of the
+        task is within its concurrency and rate limits, and does not hold them
+        while waiting to be retried."""
+        retry_policy = task.retry_policy
+        start_time = time.time()
+        queue_wait_time = 0.0
+        attempt = 0
+        try:
+            while True:
+                queue_wait_time += await self._acquire_limits(task, priority)
+                try:
+                    return await self._run_task_with_hedging(task, priority)
+                except Exception as e:
+                    if (
+                        retry_policy is None
+                        or attempt >= retry_policy.max_retries
+                        or not isinstance(e, retry_policy.retry_on)
+                    ):
+                        raise
+                    delay = retry_policy.get_delay(attempt)
+                    log(
+                        f"Retrying task {task.idx} in {delay:.2f}s: {type(e).__name__}"
+                    )
+                    if self.tool_stats is not None:
+                        self.tool_stats.on_tool_retry(task.name)
+                finally:
+                    self._release_limits(task)
+                await asyncio.sleep(delay)
+                attempt += 1
+        except Exception:
+            if self.tool_stats is not None:
+                self.tool_stats.on_tool_error(task.name)
+            raise
+        finally:
+            if self.tool_stats is not None:
+                self.tool_stats.on_tool_end(
+                    task.name, time.time() - start_time - queue_wait_time
+                )
+
+    async def _acquire_limits(self, task: Task, priority: float = 0) -> float:
+        """Wait until the tool of the task is within its concurrency and rate
+        limits, and return how long it took."""
+        queue_start_time = time.time()
+        if task.limiter is not None:
+            await task.limiter.acquire(priority)
+        wait_time = time.time() - queue_start_time
+        if self.tool_stats is not None:
+            self.tool_stats.on_tool_queue_end(task.name, wait_time)
+        return wait_time
+
+    def _release_limits(self, task: Task):
+        if task.limiter is not None:
+            task.limiter.release()
+
+    async def _run_task_with_hedging(self, task: Task, priority: float = 0) -> Any:
+        """Run the task, and if the tool hedges, issue a duplicate call once the
+        first one takes longer than the p95 latency of the tool. The duplicate
+        waits for the limits of the tool like any other call. The first
+        successful response wins and the other call is cancelled."""
+        hedge_delay = (
+            self.latency_tracker.get_percentile(task.name, 95) if task.hedge else None
+        )
+        if hedge_delay is None:
+            return await self._call_task(task)
+
+        calls = {asyncio.ensure_future(self._call_task(task))}
+        try:
+            done, _ = await asyncio.wait(calls, timeout=hedge_delay)
+            if not done:
+                log(f"Hedging task {task.idx} after {hedge_delay:.2f}s")
+                if self.tool_stats is not None:
+                    self.tool_stats.on_tool_hedge(task.name)
+                calls.add(
+                    asyncio.ensure_future(self._call_task_with_limits(task, priority))
+                )
+            pending = calls
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for call in done:
+                    if call.exception() is None:
+                        return call.result()
+                if not pending:
+                    # all the calls failed
+                    return done.pop().result()
+        finally:
+            for call in calls:
+                call.cancel()
+
+    async def _call_task_with_limits(self, task: Task, priority: float = 0) -> Any:
+        await self._acquire_limits(task, priority)
+        try:
+            return await self._call_task(task)
+        finally:
+            self._release_limits(task)
+
+    async def _call_task(self, task: Task) -> Any:
+        start_time = time.time()
+        try:
+            return await asyncio.wait_for(task(), task.timeout)
+        finally:
+            # calls that time out or are cancelled, e.g. the slow call of a
+            # hedged task, are recorded by how long they ran for, so that the
+            # percentiles are not only estimated from the faster calls
+            self.latency_tracker.observe(task.name, time.time() - start_time)
+
+    def _fail_task(self, task: Task, reason: str):
+        """Surface the failure to the joinner as the observation of the task."""
+        log(f"Task {task.idx} failed: {reason}")
+        task.observation = f"Error: {reason}"
+        self.failed_tasks.add(task.idx)
+
+    def _mark_done(self, task: Task):
+        if self._is_done(task.idx):
+            # e.g. already failed by a plan timeout
+            return
         self.tasks_done[task.idx].set()
+        self.num_tasks_done += 1
+        self._on_task_done(task.idx)
+
+    def _on_task_done(self, task_idx: int):
+        """Unblock the dependents of a finished task and launch the ready ones."""
+        ready_tasks = []
+        for dependent in self.dependents.pop(task_idx, []):
+            self.num_pending_dependencies[dependent] -= 1
+            if self.num_pending_dependencies[dependent] == 0:
+                ready_tasks.append(dependent)
+        self._launch_tasks(ready_tasks)
+        self._check_all_done()
+
+    def _finish_receiving_tasks(self):
+        self.no_more_tasks = True
+        self._drop_unknown_dependencies()
+        self._launch_executable_tasks()
+        self._check_all_done()
+
+    def _abort(self, reason: str):
+        """Fail all the tasks that are not done yet, and stop the running ones."""
+        self.remaining_tasks.clear()
+        for task_idx, task in self.tasks.items():
+            if self._is_done(task_idx):
+                continue
+            if not task.is_join:
+                self._fail_task(task, reason)
+            self.tasks_done[task_idx].set()
+            self.num_tasks_done += 1
+        self.cancel()
+        self.all_done.set()
+
+    def cancel(self):
+        """Cancel all the running tasks, e.g. when the query is abandoned."""
+        for running_task in list(self._running_tasks):
+            running_task.cancel()
+
+    async def _run_with_plan_timeout(self, schedule: Awaitable[None]):
+        try:
+            await asyncio.wait_for(schedule, self.plan_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out = True
+            self._abort(f"the plan timed out after {self.plan_timeout}s")
+        finally:
+            # don't leave tasks running in the background if the caller gave up
+            self.cancel()
+
+    async def _schedule(self):
+        self._finish_receiving_tasks()
+        await self.all_done.wait()
 
     async def schedule(self):
         """Run all tasks in self.tasks in parallel, respecting dependencies."""
-        # run until all tasks are done
-        while not self._all_tasks_done():
-            # Find tasks with no dependencies or with all dependencies met
-            executable_tasks = self._get_all_executable_tasks()
+        await self._run_with_plan_timeout(self._schedule())
 
-            for task_name in executable_tasks:
-                asyncio.create_task(self._run_task(self.tasks[task_name]))
-                self.remaining_tasks.remove(task_name)
+    async def _aschedule(self, task_queue: asyncio.Queue[Optional[Task]]):
+        while True:
+            # Wait for a new task to be added to the queue
+            task = await task_queue.get()
+
+            # Check for sentinel value indicating end of tasks
+            if task is None:
+                break
 
-            await asyncio.sleep(SCHEDULING_INTERVAL)
+            # Parse and set the new task, and run it right away if it is executable
+            self.set_tasks({task.idx: task})
+            if self.num_pending_dependencies[task.idx] == 0:
+                self._launch_tasks([task.idx])
+
+        self._finish_receiving_tasks()
+        await self.all_done.wait()
 
     async def aschedule(self, task_queue: asyncio.Queue[Optional[Task]], func):
         """Asynchronously listen to task_queue and schedule tasks as they arrive."""
-        no_more_tasks = False  # Flag to check if all tasks are received
-
-        while True:
-            if not no_more_tasks:
-                # Wait for a new task to be added to the queue
-                task = await task_queue.get()
-
-                # Check for sentinel value indicating end of tasks
-                if task is None:
-                    no_more_tasks = True
-                else:
-                    # Parse and set the new tasks
-                    self.set_tasks({task.idx: task})
-
-            # Schedule and run executable tasks
-            executable_tasks = self._get_all_executable_tasks()
-
-            if executable_tasks:
-                for task_name in executable_tasks:
-                    asyncio.create_task(self._run_task(self.tasks[task_name]))
-                    self.remaining_tasks.remove(task_name)
-            elif no_more_tasks and self._all_tasks_done():
-                # Exit the loop if no more tasks are expected and all tasks are done
-                break
-            else:
-                # If no executable tasks are found, sleep for the SCHEDULING_INTERVAL
-                await asyncio.sleep(SCHEDULING_INTERVAL)
+        await self._run_with_plan_timeout(self._aschedule(task_queue))
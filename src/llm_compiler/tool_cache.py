@@ -0,0 +1,110 @@
+"""In-memory cache of tool results shared across plans and queries."""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class _CallAbandoned(Exception):
+    """The call that other identical calls were waiting for was cancelled."""
+
+
+class ToolResultCache:
+    """Memoizes tool results keyed by (tool name, resolved args), with TTL and
+    LRU eviction.
+
+    Identical calls that are in flight at the same time are deduplicated
+    (single-flight): only the first one calls the tool, and the others wait for
+    its result. Failed calls are not cached.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_entries: int = 10_000):
+        """
+        Args:
+            ttl: Time-to-live of an entry in seconds. None means no expiration.
+            max_entries: Max number of entries to keep.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (result, created_at), in LRU order
+        self._entries: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(tool_name: str, args: Any) -> Hashable:
+        return (tool_name, repr(args))
+
+    def _get(self, key: Hashable) -> Tuple[bool, Any]:
+        if key not in self._entries:
+            return False, None
+        result, created_at = self._entries[key]
+        if self.ttl is not None and time.time() - created_at > self.ttl:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, result
+
+    def _put(self, key: Hashable, result: Any) -> None:
+        self._entries[key] = (result, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_call(
+        self, key: Hashable, call: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """Returns the cached result of the key, or the result of `call`, along
+        with whether the tool call was saved."""
+        while True:
+            hit, result = self._get(key)
+            if hit:
+                self.hits += 1
+                return result, True
+            if key not in self._in_flight:
+                break
+            try:
+                # don't cancel the shared call if this waiter is cancelled
+                result = await asyncio.shield(self._in_flight[key])
+                self.hits += 1
+                return result, True
+            except _CallAbandoned:
+                # the caller of the shared call gave up, so call it again
+                continue
+
+        self.misses += 1
+        in_flight = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = in_flight
+        try:
+            result = await call()
+        except Exception as e:
+            in_flight.set_exception(e)
+            raise
+        except BaseException:
+            in_flight.set_exception(_CallAbandoned())
+            raise
+        else:
+            self._put(key, result)
+            in_flight.set_result(result)
+            return result, False
+        finally:
+            del self._in_flight[key]
+            if in_flight.done() and not in_flight.cancelled():
+                # nobody may be waiting, so mark the exception as retrieved
+                in_flight.exception()
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
@@ -3,7 +3,10 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import inspect
+import random
+import time
 from functools import partial
 from inspect import signature
 from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type, Union
@@ -16,6 +19,7 @@ from langchain.pydantic_v1 import (
     BaseModel,
     Extra,
     Field,
+    PrivateAttr,
     create_model,
     validate_arguments,
 )
@@ -92,7 +96,180 @@ class ToolException(Exception):
     pass
 
 
-class Tool(BaseTool):
+class PrioritySemaphore:
+    """A semaphore that wakes up the waiter with the highest priority first, and
+    waiters of the same priority in FIFO order."""
+
+    def __init__(self, value: int) -> None:
+        self._value = value
+        # heap of (-priority, arrival order, future)
+        self._waiters: list[tuple[float, int, asyncio.Future]] = []
+        self._num_arrivals = 0
+
+    async def acquire(self, priority: float = 0) -> None:
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, self._num_arrivals, future))
+        self._num_arrivals += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over right before the cancellation
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # hand the slot over to the waiter
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class ToolLimiter:
+    """Bounds the number of concurrent calls of a tool, and the rate at which
+    calls are started with a token bucket of `burst` tokens refilled at
+    `rate_limit` tokens per second.
+    Calls waiting for the limits are let through in the order of their priority."""
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        rate_limit: Optional[float] = None,
+        burst: int = 1,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self._semaphore = (
+            PrioritySemaphore(max_concurrency) if max_concurrency is not None else None
+        )
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        # waiters take tokens one at a time
+        self._bucket_lock = PrioritySemaphore(1)
+
+    async def _take_token(self, priority: float) -> None:
+        await self._bucket_lock.acquire(priority)
+        try:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._last_refill) * self.rate_limit,
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate_limit)
+        finally:
+            self._bucket_lock.release()
+
+    async def acquire(self, priority: float = 0) -> None:
+        if self._semaphore is not None:
+            await self._semaphore.acquire(priority)
+        if self.rate_limit is not None:
+            try:
+                await self._take_token(priority)
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self) -> None:
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+class RetryPolicy:
+    """Retry failed calls of a tool with bounded exponential backoff."""
+
+    def __init__(
+        self,
+        max_retries: int = 2,
+        initial_delay: float = 0.5,
+        max_delay: float = 8.0,
+        retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+    ) -> None:
+        """
+        Args:
+            max_retries: Max number of retries after the first attempt.
+            initial_delay: Seconds to wait before the first retry, doubled for
+                every subsequent retry.
+            max_delay: Max seconds to wait before a retry.
+            retry_on: Exceptions that are considered transient, e.g. timeouts.
+        """
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def get_delay(self, attempt: int) -> float:
+        """Seconds to wait after the failure of the given attempt (from 0),
+        with jitter so that concurrent retries do not fire at once."""
+        delay = min(self.initial_delay * 2**attempt, self.max_delay)
+        return delay * random.uniform(0.5, 1.0)
+
+
+class ObservationPolicy:
+    """How much of the observations of a tool to feed back to the LLMs."""
+
+    def __init__(
+        self, max_sentences: Optional[int] = None, max_chars: Optional[int] = None
+    ) -> None:
+        """
+        Args:
+            max_sentences: Max number of sentences to keep. None means all.
+            max_chars: Max number of characters to keep. None means all.
+        """
+        self.max_sentences = max_sentences
+        self.max_chars = max_chars
+
+
+class _PolicyTool(BaseTool):
+    """Execution policies of a tool, shared by Tool and StructuredTool, and
+    enforced by the TaskFetchingUnit."""
+
+    max_concurrency: Optional[int] = None
+    """Max number of concurrent calls of the tool, shared by all queries."""
+    rate_limit: Optional[float] = None
+    """Max number of calls started per second, shared by all queries."""
+    rate_limit_burst: int = 1
+    """Number of calls that can be started at once under `rate_limit`."""
+    timeout: Optional[float] = None
+    """Max seconds a call of the tool can take."""
+    retry_policy: Optional[RetryPolicy] = None
+    """How to retry failed calls of the tool. None means no retries."""
+    hedge: bool = False
+    """Whether to issue a duplicate call when a call takes longer than the p95
+    latency of the tool, and take the first response. Only for idempotent tools."""
+    cacheable: bool = True
+    """Whether the results of the tool can be memoized. Disable for
+    non-deterministic tools."""
+    observation_policy: Optional[ObservationPolicy] = None
+    """How much of the observations to feed back to the LLMs. None means all,
+    or the default policy of the observation compressor if any."""
+    _limiter: Optional[ToolLimiter] = PrivateAttr(default=None)
+
+    def get_limiter(self) -> Optional[ToolLimiter]:
+        """The limiter enforcing `max_concurrency` and `rate_limit`, if any."""
+        if self.max_concurrency is None and self.rate_limit is None:
+            return None
+        if self._limiter is None:
+            self._limiter = ToolLimiter(
+                max_concurrency=self.max_concurrency,
+                rate_limit=self.rate_limit,
+                burst=self.rate_limit_burst,
+            )
+        return self._limiter
+
+
+class Tool(_PolicyTool):
     """Tool that takes in function or coroutine directly."""
 
     description: str = ""
@@ -222,7 +399,7 @@ class Tool(BaseTool):
         )
 
 
-class StructuredTool(BaseTool):
+class StructuredTool(_PolicyTool):
     """Tool that can operate on any number of inputs."""
 
     description: str = ""